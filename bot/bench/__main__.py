@@ -0,0 +1,81 @@
+import argparse
+import json
+import sys
+from bench import harness
+
+# ==================================================================================
+# python -m bench run --guilds 50 --rate 40 --duration 30 --output after.json
+# python -m bench compare before.json after.json
+#
+# Run from the bot/ directory. Extra evo.py settings (LLM_MAX_IN_FLIGHT,
+# REFLECTION_MODE, ...) are read from the environment as usual.
+# ==================================================================================
+
+def print_results(results):
+    for section in ('messages', 'throughput', 'reply_latency_ms', 'handler_latency_ms', 'loop_lag_ms', 'calls_per_triggered_message'):
+        values = ', '.join(f"{name}={value}" for name, value in results[section].items())
+        print(f"{section:<30} {values}")
+
+def run_command(args):
+    results = harness.run(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+def compare_command(args):
+    rows = harness.compare(harness.load_results(args.baseline), harness.load_results(args.candidate), args.threshold, args.min_ms)
+    regressions = 0
+    print(f"{'metric':<45} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for name, old_value, new_value, change, worse in rows:
+        regressions += worse
+        print(f"{name:<45} {old_value:>12} {new_value:>12} {change:>+8.1%}{'  REGRESSION' if worse else ''}")
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}.")
+    return 1 if regressions else 0
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description="Offline load test for evo.py's on_message.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Replay synthetic traffic and report the results.')
+    run.add_argument('--guilds', type=int, default=20)
+    run.add_argument('--channels', type=int, default=2, help='Channels per guild.')
+    run.add_argument('--users', type=int, default=30, help='Users per guild.')
+    run.add_argument('--rate', type=float, default=20, help='Messages per second across all guilds.')
+    run.add_argument('--duration', type=float, default=10, help='Seconds of traffic.')
+    run.add_argument('--skew', type=float, default=1.0, help='Zipf exponent for guild popularity (0 is uniform).')
+    run.add_argument('--trigger-ratio', type=float, default=0.3, help='Share of messages that address the bot.')
+    run.add_argument('--mention-ratio', type=float, default=0.1, help='Share of messages that mention another user.')
+    run.add_argument('--streaming-ratio', type=float, default=0.2, help='Share of guilds with streaming replies on.')
+    run.add_argument('--avatar-ratio', type=float, default=0.3, help='Share of guilds with a custom avatar (webhook replies).')
+    run.add_argument('--response-cache-ratio', type=float, default=0.0, help='Share of guilds with the response cache on.')
+    run.add_argument('--dead-key-ratio', type=float, default=0.0, help='Share of guilds whose primary API key is rejected.')
+    run.add_argument('--warm-ratio', type=float, default=0.5, help='Share of users with existing memories.')
+    run.add_argument('--history-turns', type=int, default=10)
+    run.add_argument('--gemini-latency', type=float, default=0.8)
+    run.add_argument('--gemini-failure-rate', type=float, default=0.01)
+    run.add_argument('--stream-chunk-delay', type=float, default=0.05)
+    run.add_argument('--firestore-latency', type=float, default=0.03)
+    run.add_argument('--firestore-failure-rate', type=float, default=0.0)
+    run.add_argument('--discord-latency', type=float, default=0.05)
+    run.add_argument('--discord-failure-rate', type=float, default=0.0)
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--output', help='Write the results as JSON to this file.')
+    run.add_argument('--verbose', action='store_true', help="Show evo.py's own log output.")
+    run.set_defaults(handler=run_command)
+
+    diff = commands.add_parser('compare', help='Compare two result files and flag regressions.')
+    diff.add_argument('baseline')
+    diff.add_argument('candidate')
+    diff.add_argument('--threshold', type=float, default=0.1, help='Relative change that counts as a regression.')
+    diff.add_argument('--min-ms', type=float, default=1.0, help='Ignore timing changes smaller than this many milliseconds.')
+    diff.set_defaults(handler=compare_command)
+
+    args = parser.parse_args()
+    handler = args.handler
+    del args.handler
+    sys.exit(handler(args) or 0)
+
+if __name__ == "__main__":
+    main()
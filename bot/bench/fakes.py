@@ -0,0 +1,350 @@
+import asyncio
+import contextvars
+import copy
+import itertools
+import json
+import time
+from collections import Counter
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore import Increment
+
+# ==================================================================================
+# LOCAL STAND-INS
+# Just enough of Discord, Firestore and Gemini for evo.py to run offline. Every
+# call is counted, and every service has configurable latency and failure rate.
+# ==================================================================================
+
+calls = Counter()
+
+# Set by the harness around each on_message call so replies, webhook sends and
+# channel sends can be attributed back to the message that caused them.
+current_message = contextvars.ContextVar('current_message', default=None)
+
+class FakeServiceError(Exception):
+    pass
+
+class Service:
+    def __init__(self, name, rng, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.name = name
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    async def call(self, operation, error=FakeServiceError):
+        calls[f"{self.name}.{operation}"] += 1
+        delay = max(0.0, self.rng.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        if delay: await asyncio.sleep(delay)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            calls[f"{self.name}.{operation}.failed"] += 1
+            raise error(f"Simulated {self.name} failure during {operation}")
+
+# --- Firestore ---
+# One in-memory document store that answers both the sync client (only used for
+# on_snapshot) and the AsyncClient calls evo.py makes.
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+class FakeChange:
+    class Type:
+        def __init__(self, name):
+            self.name = name
+
+    def __init__(self, kind, document):
+        self.type = FakeChange.Type(kind)
+        self.document = document
+
+class FakeWatch:
+    def __init__(self, firestore, path, callback):
+        self.firestore = firestore
+        self.path = path
+        self.callback = callback
+
+    def unsubscribe(self):
+        self.firestore.watches.remove(self)
+
+class FakeDocumentRef:
+    def __init__(self, firestore, path):
+        self.firestore = firestore
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollectionRef(self.firestore, self.path + (name,))
+
+    async def get(self):
+        await self.firestore.service.call('read')
+        return FakeSnapshot(self.id, self.firestore.docs.get(self.path))
+
+    async def set(self, data, merge=False):
+        await self.firestore.service.call('write')
+        self.firestore.apply(self.path, data, merge)
+
+class FakeCollectionRef:
+    def __init__(self, firestore, path):
+        self.firestore = firestore
+        self.path = path
+
+    def document(self, doc_id):
+        return FakeDocumentRef(self.firestore, self.path + (doc_id,))
+
+    def _children(self):
+        depth = len(self.path) + 1
+        return [(path, data) for path, data in self.firestore.docs.items() if len(path) == depth and path[:-1] == self.path]
+
+    async def stream(self):
+        await self.firestore.service.call('query')
+        for path, data in self._children():
+            calls['firestore.read'] += 1
+            yield FakeSnapshot(path[-1], data)
+
+    def on_snapshot(self, callback):
+        watch = FakeWatch(self.firestore, self.path, callback)
+        self.firestore.watches.append(watch)
+        changes = [FakeChange('ADDED', FakeSnapshot(path[-1], data)) for path, data in self._children()]
+        callback([change.document for change in changes], changes, time.time())
+        return watch
+
+class FakeBatch:
+    def __init__(self, firestore):
+        self.firestore = firestore
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref.path, data, merge))
+
+    async def commit(self):
+        await self.firestore.service.call('batch_commit')
+        calls['firestore.write'] += len(self.writes)
+        for path, data, merge in self.writes:
+            self.firestore.apply(path, data, merge)
+
+class FakeFirestore:
+    def __init__(self, service):
+        self.service = service
+        self.docs = {}
+        self.watches = []
+
+    def collection(self, name):
+        return FakeCollectionRef(self, (name,))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def apply(self, path, data, merge):
+        existed = path in self.docs
+        doc = self.docs[path] if merge and existed else {}
+        for field, value in data.items():
+            if isinstance(value, Increment): doc[field] = doc.get(field, 0) + value._value
+            else: doc[field] = copy.deepcopy(value)
+        self.docs[path] = doc
+        for watch in self.watches:
+            if path[:-1] == watch.path:
+                change = FakeChange('MODIFIED' if existed else 'ADDED', FakeSnapshot(path[-1], self.docs[path]))
+                watch.callback([change.document], [change], time.time())
+
+    # Seeding does not count as traffic.
+    def seed(self, path, data):
+        self.docs[tuple(path)] = copy.deepcopy(data)
+
+# --- Gemini ---
+class FakeUsage:
+    def __init__(self, prompt, text):
+        self.prompt_token_count = len(prompt) // 4 + 1
+        self.candidates_token_count = len(text) // 4 + 1
+        self.total_token_count = self.prompt_token_count + self.candidates_token_count
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeResponse:
+    def __init__(self, prompt, text):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt, text)
+
+class FakeStreamResponse:
+    def __init__(self, gemini, prompt, text):
+        self.gemini = gemini
+        self.prompt = prompt
+        self.full_text = text
+        self.usage_metadata = None
+
+    async def __aiter__(self):
+        words = self.full_text.split(' ')
+        for i in range(0, len(words), self.gemini.stream_chunk_words):
+            await asyncio.sleep(self.gemini.stream_chunk_delay)
+            yield FakeChunk(' '.join(words[i:i + self.gemini.stream_chunk_words]) + ' ')
+        self.usage_metadata = FakeUsage(self.prompt, self.full_text)
+
+class FakeGemini:
+    def __init__(self, service, reply_words=40, stream_chunk_words=8, stream_chunk_delay=0.05, dead_keys=()):
+        self.service = service
+        self.reply_words = reply_words
+        self.stream_chunk_words = stream_chunk_words
+        self.stream_chunk_delay = stream_chunk_delay
+        self.dead_keys = set(dead_keys)
+
+    def reply_for(self, prompt):
+        if 'Respond with only a JSON object' in prompt:
+            return json.dumps({'personal': {}, 'gossip': {}})
+        return ' '.join(itertools.islice(itertools.cycle("sure thing that sounds like a great idea honestly".split()), self.reply_words))
+
+class FakeModel:
+    def __init__(self, gemini, api_key, model_name, system_instruction):
+        self.gemini = gemini
+        self.api_key = api_key
+        self.model_name = f"models/{model_name}"
+        self.system_instruction = system_instruction
+
+    async def generate_content_async(self, prompt, stream=False, request_options=None):
+        if self.api_key in self.gemini.dead_keys:
+            calls['gemini.generate'] += 1
+            calls['gemini.generate.dead_key'] += 1
+            raise google_exceptions.PermissionDenied("API key not valid.")
+        await self.gemini.service.call('generate', error=google_exceptions.ServiceUnavailable)
+        text = self.gemini.reply_for(prompt)
+        if stream: return FakeStreamResponse(self.gemini, prompt, text)
+        return FakeResponse(prompt, text)
+
+class FakeModelPool:
+    def __init__(self, gemini):
+        self.gemini = gemini
+        self.models = {}
+
+    def get(self, api_key, model_name, system_instruction):
+        key = (api_key, model_name, system_instruction)
+        model = self.models.get(key)
+        if model is None:
+            model = self.models[key] = FakeModel(self.gemini, api_key, model_name, system_instruction)
+        return model
+
+# --- Discord ---
+class FakeDiscord:
+    def __init__(self, service):
+        self.service = service
+        self.ids = itertools.count(10 ** 17)
+        self.first_reply = {}
+
+    def next_id(self):
+        return next(self.ids)
+
+    def record_reply(self):
+        message = current_message.get()
+        if message is not None and message.id not in self.first_reply:
+            self.first_reply[message.id] = time.perf_counter()
+
+class FakeUser:
+    def __init__(self, discord_, user_id, name, bot=False):
+        self.discord = discord_
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+    def mentioned_in(self, message):
+        return any(user.id == self.id for user in message.mentions)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeMember(FakeUser):
+    def __init__(self, discord_, user, nick=None):
+        super().__init__(discord_, user.id, user.name, user.bot)
+        self.nick = nick
+
+    async def edit(self, nick=None):
+        await self.discord.service.call('edit_member')
+        self.nick = nick
+
+class FakeGuild:
+    def __init__(self, discord_, guild_id, bot_user):
+        self.id = guild_id
+        self.me = FakeMember(discord_, bot_user)
+
+class FakeTyping:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        await self.channel.discord.service.call('typing')
+
+    async def __aexit__(self, *exc):
+        return False
+
+class FakeWebhook:
+    def __init__(self, discord_, channel, user):
+        self.discord = discord_
+        self.channel = channel
+        self.user = user
+        self.id = discord_.next_id()
+
+    async def send(self, content=None, username=None, avatar_url=None, wait=False):
+        await self.discord.service.call('webhook_send')
+        self.discord.record_reply()
+        return FakeSentMessage(self.discord, content)
+
+class FakeChannel:
+    def __init__(self, discord_, channel_id, guild):
+        self.discord = discord_
+        self.id = channel_id
+        self.guild = guild
+        self.hooks = []
+
+    def typing(self):
+        return FakeTyping(self)
+
+    async def send(self, content):
+        await self.discord.service.call('send')
+        self.discord.record_reply()
+        return FakeSentMessage(self.discord, content)
+
+    async def webhooks(self):
+        await self.discord.service.call('list_webhooks')
+        return list(self.hooks)
+
+    async def create_webhook(self, name):
+        await self.discord.service.call('create_webhook')
+        webhook = FakeWebhook(self.discord, self, self.guild.me)
+        self.hooks.append(webhook)
+        return webhook
+
+class FakeSentMessage:
+    def __init__(self, discord_, content):
+        self.discord = discord_
+        self.id = discord_.next_id()
+        self.content = content
+
+    async def edit(self, content=None):
+        await self.discord.service.call('edit_message')
+        self.content = content
+
+class FakeMessage:
+    def __init__(self, discord_, guild, channel, author, content, mentions=()):
+        self.discord = discord_
+        self.id = discord_.next_id()
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.mentions = list(mentions)
+        self.reference = None
+        clean = content
+        for user in self.mentions:
+            clean = clean.replace(user.mention, f"@{user.display_name}")
+        self.clean_content = clean
+
+    async def reply(self, content):
+        await self.discord.service.call('reply')
+        self.discord.record_reply()
+        return FakeSentMessage(self.discord, content)
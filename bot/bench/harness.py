@@ -0,0 +1,257 @@
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from unittest import mock
+from cryptography.fernet import Fernet
+from bench import fakes
+
+# ==================================================================================
+# LOAD-TEST HARNESS
+# Imports evo.py against the fakes, replays synthetic multi-guild traffic through
+# on_message, and reports throughput, reply latency, event-loop lag and how many
+# Gemini / Firestore / Discord calls each triggered message cost.
+# ==================================================================================
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGE_TEMPLATES = [
+    "lol",
+    "hi",
+    "anyone around tonight?",
+    "that match yesterday was wild",
+    "I think my favourite food is probably ramen, I could eat it every day",
+    "I just got back from a trip to Lisbon and I am still tired",
+    "does anyone know a good keyboard for programming?",
+    "my cat knocked my coffee over again this morning",
+    "I'm learning to play the guitar and my fingers hurt",
+]
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values: return {f"p{point}": None for point in points} | {'max': None}
+    ordered = sorted(values)
+    result = {f"p{point}": round(ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))], 3) for point in points}
+    result['max'] = round(ordered[-1], 3)
+    return result
+
+class Bench:
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.discord = fakes.FakeDiscord(fakes.Service('discord', self.rng, options.discord_latency, options.discord_latency / 4, options.discord_failure_rate))
+        self.firestore = fakes.FakeFirestore(fakes.Service('firestore', self.rng, options.firestore_latency, options.firestore_latency / 4, options.firestore_failure_rate))
+        self.gemini = fakes.FakeGemini(
+            fakes.Service('gemini', self.rng, options.gemini_latency, options.gemini_latency / 4, options.gemini_failure_rate),
+            stream_chunk_delay=options.stream_chunk_delay
+        )
+        self.bot_user = fakes.FakeUser(self.discord, self.discord.next_id(), 'Evo', bot=True)
+        self.guilds = []
+        self.evo = None
+        self.started = {}
+        self.finished = {}
+        self.lag = []
+
+    # --- Setup ---
+    def seed(self, cipher):
+        options = self.options
+        for i in range(options.guilds):
+            guild = fakes.FakeGuild(self.discord, self.discord.next_id() << 22, self.bot_user)
+            channels = [fakes.FakeChannel(self.discord, self.discord.next_id(), guild) for _ in range(options.channels)]
+            users = [fakes.FakeUser(self.discord, self.discord.next_id(), f"user{i}_{j}") for j in range(options.users)]
+            self.guilds.append((guild, channels, users))
+
+            primary_key = f"key-{i}-primary"
+            if self.rng.random() < options.dead_key_ratio: self.gemini.dead_keys.add(primary_key)
+            config = {
+                'custom_bot_name': 'Evo',
+                'designated_channel': 'all',
+                'ai_model': 'gemini-1.5-flash',
+                'encrypted_api_key': cipher.encrypt(primary_key.encode()).decode(),
+                'encrypted_backup_api_key': cipher.encrypt(f"key-{i}-backup".encode()).decode(),
+                'streaming_replies': self.rng.random() < options.streaming_ratio,
+                'response_cache': self.rng.random() < options.response_cache_ratio,
+            }
+            if self.rng.random() < options.avatar_ratio:
+                config['custom_avatar_url'] = f"https://example.invalid/avatars/{i}.png"
+            self.firestore.seed(['server_configs', str(guild.id)], config)
+
+            for user in users[:int(len(users) * options.warm_ratio)]:
+                history = [f"User: {self.rng.choice(MESSAGE_TEMPLATES)}\nAI: sure thing\n" for _ in range(options.history_turns)]
+                self.firestore.seed(['memories', str(guild.id), 'users', str(user.id)], {'conversation_history': history, 'personal_summary': 'Likes ramen.'})
+
+    # evo.py builds its clients at import time, so the fakes are swapped in around the import.
+    def load_evo(self):
+        encryption_key = Fernet.generate_key()
+        self.seed(Fernet(encryption_key))
+        self.tempdir = tempfile.TemporaryDirectory()
+        os.environ.update({
+            'DISCORD_BOT_TOKEN': 'bench',
+            'ENCRYPTION_KEY': encryption_key.decode(),
+            'FIREBASE_CREDENTIALS_JSON': '{}',
+            'MEMORY_JOURNAL_PATH': os.path.join(self.tempdir.name, 'memory_journal.jsonl'),
+            'STATE_BACKEND': 'local',
+        })
+        os.environ.pop('METRICS_PORT', None)
+        os.chdir(BOT_DIR)
+        if BOT_DIR not in sys.path: sys.path.insert(0, BOT_DIR)
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch('dotenv.load_dotenv', lambda *args, **kwargs: False))
+            stack.enter_context(mock.patch('firebase_admin.credentials.Certificate', lambda *args, **kwargs: None))
+            stack.enter_context(mock.patch('firebase_admin.initialize_app', lambda *args, **kwargs: None))
+            stack.enter_context(mock.patch('firebase_admin.firestore.client', lambda *args, **kwargs: self.firestore))
+            stack.enter_context(mock.patch('firebase_admin.firestore_async.client', lambda *args, **kwargs: self.firestore))
+            sys.modules.pop('evo', None)
+            self.evo = importlib.import_module('evo')
+
+        self.evo.model_pool = fakes.FakeModelPool(self.gemini)
+        self.evo.bot._connection.user = self.bot_user
+        # Reads made while loading configs are setup, not traffic
+        fakes.calls.clear()
+
+    # --- Traffic ---
+    def make_message(self):
+        options = self.options
+        weights = [1 / (i + 1) ** options.skew for i in range(len(self.guilds))]
+        guild, channels, users = self.rng.choices(self.guilds, weights)[0]
+        author = self.rng.choice(users)
+        content = self.rng.choice(MESSAGE_TEMPLATES)
+        mentions = []
+        if self.rng.random() < options.trigger_ratio:
+            if self.rng.random() < 0.5:
+                mentions.append(self.bot_user)
+                content = f"{self.bot_user.mention} {content}"
+            else:
+                content = f"hey evo, {content}"
+        if len(users) > 1 and self.rng.random() < options.mention_ratio:
+            other = self.rng.choice([user for user in users if user != author])
+            mentions.append(other)
+            content = f"{content} right {other.mention}?"
+        return fakes.FakeMessage(self.discord, guild, self.rng.choice(channels), author, content, mentions)
+
+    async def deliver(self, message):
+        fakes.current_message.set(message)
+        self.started[message.id] = time.perf_counter()
+        try:
+            await self.evo.on_message(message)
+        finally:
+            self.finished[message.id] = time.perf_counter()
+
+    async def monitor_loop(self, interval=0.01):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.append((time.perf_counter() - started - interval) * 1000)
+
+    async def run(self):
+        options = self.options
+        evo = self.evo
+        evo.store.start()
+        evo.usage_ledger.start()
+        evo.reflections.start()
+        monitor = asyncio.create_task(self.monitor_loop())
+
+        tasks = []
+        started = time.perf_counter()
+        deadline = started + options.duration
+        while time.perf_counter() < deadline:
+            tasks.append(asyncio.create_task(self.deliver(self.make_message())))
+            await asyncio.sleep(self.rng.expovariate(options.rate))
+        sending_seconds = time.perf_counter() - started
+        await asyncio.gather(*tasks, return_exceptions=True)
+        traffic_seconds = time.perf_counter() - started
+
+        # Background work the traffic caused still counts towards calls per message
+        if evo.reflection_batcher: await evo.reflection_batcher.flush_all()
+        await evo.reflections.drain()
+        await evo.usage_ledger.close()
+        await evo.store.close()
+        monitor.cancel()
+        await asyncio.gather(monitor, return_exceptions=True)
+        return self.report(len(tasks), sending_seconds, traffic_seconds)
+
+    # --- Report ---
+    def report(self, sent, sending_seconds, traffic_seconds):
+        evo = self.evo
+        options = self.options
+        calls = fakes.calls
+        messages = {dict(key).get('result'): value for key, value in evo.MESSAGES.values.items()}
+        triggered = messages.get('triggered', 0)
+        replied = len(self.discord.first_reply)
+        reply_latency = [(at - self.started[message_id]) * 1000 for message_id, at in self.discord.first_reply.items()]
+        handler_latency = [(self.finished[message_id] - self.started[message_id]) * 1000 for message_id in self.finished]
+
+        def total(service, *operations):
+            return sum(calls[f"{service}.{operation}"] for operation in operations)
+        per_message = lambda count: round(count / triggered, 3) if triggered else None
+
+        return {
+            'config': vars(options),
+            'messages': {
+                'sent': sent,
+                'triggered': triggered,
+                'replied': replied,
+                'shed': evo.llm_scheduler.stats.shed,
+                'over_quota': messages.get('over_quota', 0),
+                'errors': sum(evo.ERRORS.values.values()),
+            },
+            'throughput': {
+                # Offered load over the sending window; replies over the time until the last one finished
+                'messages_per_sec': round(sent / sending_seconds, 2),
+                'replies_per_sec': round(replied / traffic_seconds, 2),
+            },
+            'reply_latency_ms': percentiles(reply_latency),
+            'handler_latency_ms': percentiles(handler_latency),
+            'loop_lag_ms': percentiles(self.lag),
+            'calls_per_triggered_message': {
+                'gemini': per_message(calls['gemini.generate']),
+                'firestore_reads': per_message(calls['firestore.read']),
+                'firestore_writes': per_message(calls['firestore.write']),
+                'firestore_round_trips': per_message(total('firestore', 'read', 'write', 'query', 'batch_commit')),
+                'discord_rest': per_message(total('discord', 'typing', 'reply', 'send', 'webhook_send', 'edit_message', 'list_webhooks', 'create_webhook', 'edit_member')),
+            },
+            'calls': dict(sorted(calls.items())),
+        }
+
+def run(options):
+    bench = Bench(options)
+    # evo.py logs every reply and reflection; keep that out of the report unless asked for
+    output = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        bench.load_evo()
+        results = asyncio.run(bench.run())
+    return results
+
+# --- Comparing Runs ---
+# Metrics where a higher number is the regression; throughput is the other way round.
+LOWER_IS_BETTER = ('reply_latency_ms', 'handler_latency_ms', 'loop_lag_ms', 'calls_per_triggered_message')
+HIGHER_IS_BETTER = ('throughput',)
+
+def flatten(results):
+    flat = {}
+    for section in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        for name, value in results.get(section, {}).items():
+            if isinstance(value, (int, float)): flat[f"{section}.{name}"] = value
+    return flat
+
+# Timings that moved by less than min_ms are scheduler noise, whatever the relative change.
+def compare(baseline, candidate, threshold=0.1, min_ms=1.0):
+    base, new = flatten(baseline), flatten(candidate)
+    rows = []
+    for name in base.keys() & new.keys():
+        old_value, new_value = base[name], new[name]
+        change = (new_value - old_value) / old_value if old_value else (0.0 if new_value == old_value else float('inf'))
+        worse = change < -threshold if name.startswith(HIGHER_IS_BETTER) else change > threshold
+        if '_ms.' in name and abs(new_value - old_value) < min_ms: worse = False
+        rows.append((name, old_value, new_value, change, worse))
+    return sorted(rows)
+
+def load_results(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import secrets
+import signal
+import subprocess
+import threading
+import urllib.request
+from multiprocessing.managers import DictProxy
+from shared_state import StateManager
+
+# ==================================================================================
+# CLUSTER LAUNCHER
+# Runs Evo as several processes, each an AutoShardedClient over its own range of
+# shards. Each worker keeps its own config and memory caches; cross-guild state
+# (API key cooldowns) goes through a state manager served from this process.
+#
+#   python cluster.py                      # shard count from Discord, one process per core
+#   SHARD_COUNT=16 CLUSTER_PROCESSES=4 python cluster.py
+# ==================================================================================
+
+from dotenv import load_dotenv
+load_dotenv()
+
+DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+RESTART_DELAY = 5
+
+def gateway_info():
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {DISCORD_BOT_TOKEN}", "User-Agent": "DiscordBot (evo-cluster, 1.0)"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+def split_shards(shard_count, processes):
+    per_process, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        size = per_process + (1 if i < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return [shard_ids for shard_ids in ranges if shard_ids]
+
+# Serves the shared cooldown dict to the workers from a background thread.
+def start_state_manager():
+    cooldowns = {}
+    StateManager.register('cooldowns', callable=lambda: cooldowns, proxytype=DictProxy)
+    authkey = secrets.token_hex(16)
+    manager = StateManager(address=('127.0.0.1', 0), authkey=authkey.encode())
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.address
+    return f"{host}:{port}", authkey
+
+class Worker:
+    def __init__(self, cluster_id, shard_ids, shard_count, env):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.env = {
+            **env,
+            'SHARDED': 'true',
+            'SHARD_COUNT': str(shard_count),
+            'SHARD_IDS': ','.join(map(str, shard_ids)),
+            'CLUSTER_ID': str(cluster_id),
+            # Each worker needs its own write-behind journal
+            'MEMORY_JOURNAL_PATH': f"memory_journal.{cluster_id}.jsonl",
+        }
+        self.process = None
+
+    def start(self):
+        print(f"Starting cluster {self.cluster_id} with shards {self.shard_ids[0]}-{self.shard_ids[-1]}")
+        self.process = subprocess.Popen([sys.executable, 'evo.py'], env=self.env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+def main():
+    if not DISCORD_BOT_TOKEN:
+        raise ValueError("DISCORD_BOT_TOKEN is missing.")
+
+    info = gateway_info()
+    shard_count = int(os.getenv('SHARD_COUNT') or info['shards'])
+    max_concurrency = info.get('session_start_limit', {}).get('max_concurrency', 1)
+    processes = min(int(os.getenv('CLUSTER_PROCESSES') or os.cpu_count() or 1), shard_count)
+
+    address, authkey = start_state_manager()
+    env = {
+        **os.environ,
+        'STATE_BACKEND': 'manager',
+        'STATE_BACKEND_ADDRESS': address,
+        'STATE_BACKEND_AUTHKEY': authkey,
+        # Split the global LLM in-flight cap so the cluster as a whole honors it
+        'LLM_MAX_IN_FLIGHT': str(max(1, int(os.getenv('LLM_MAX_IN_FLIGHT', 16)) // processes)),
+    }
+    workers = [Worker(i, shard_ids, shard_count, env) for i, shard_ids in enumerate(split_shards(shard_count, processes))]
+    print(f"Launching {len(workers)} processes for {shard_count} shards.")
+
+    stopping = False
+    def shutdown(*_):
+        nonlocal stopping
+        stopping = True
+        for worker in workers: worker.stop()
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    # Discord allows max_concurrency identifies per 5 seconds, so stagger the workers
+    for worker in workers:
+        if stopping: break
+        worker.start()
+        time.sleep(5 * len(worker.shard_ids) / max_concurrency)
+
+    while not stopping:
+        for worker in workers:
+            code = worker.process.poll() if worker.process else None
+            if code is not None and not stopping:
+                print(f"Cluster {worker.cluster_id} exited with code {code}. Restarting in {RESTART_DELAY}s.")
+                time.sleep(RESTART_DELAY)
+                worker.start()
+        time.sleep(1)
+
+    for worker in workers:
+        if worker.process: worker.process.wait()
+
+if __name__ == "__main__":
+    main()
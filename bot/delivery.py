@@ -0,0 +1,109 @@
+import time
+import discord
+
+# ==================================================================================
+# REPLY DELIVERY
+# Posting a reply either as a normal message reply or through the custom-avatar
+# webhook, splitting anything over Discord's 2000 character limit, and (for guilds
+# that opt in) streaming the reply in with throttled edits as Gemini generates it.
+# ==================================================================================
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+# Raised by StreamingReply when Discord rejects a send or edit, so callers can tell
+# a delivery problem apart from the model failing mid-stream.
+class DeliveryFailed(Exception):
+    pass
+
+# Splits on the last newline (or failing that, space) before the limit so words
+# and lines are not cut in half. The boundary of an earlier chunk never moves as
+# more text is appended, which is what lets a streamed reply grow chunk by chunk.
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0: cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0: cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text.strip(): chunks.append(text)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+def clean_reply(text):
+    if text.lower().strip().startswith('ai:'):
+        return text.strip()[3:].lstrip()
+    return text
+
+class ReplyTarget:
+    def __init__(self, message, webhook=None, username=None, avatar_url=None, refresh_webhook=None):
+        self.message = message
+        self.webhook = webhook
+        self.username = username
+        self.avatar_url = avatar_url
+        self.refresh_webhook = refresh_webhook
+
+    # The first chunk replies to the user; follow-up chunks are plain channel messages.
+    # A cached webhook that was deleted behind our back is replaced and the send retried once.
+    async def send(self, content, first=True):
+        if self.webhook:
+            try:
+                return await self.webhook.send(content=content, username=self.username, avatar_url=self.avatar_url, wait=True)
+            except discord.NotFound:
+                if not self.refresh_webhook: raise
+                self.webhook = await self.refresh_webhook()
+                return await self.webhook.send(content=content, username=self.username, avatar_url=self.avatar_url, wait=True)
+        if first:
+            return await self.message.reply(content)
+        return await self.message.channel.send(content)
+
+    async def edit(self, sent, content):
+        await sent.edit(content=content)
+
+async def send_reply(target, text):
+    for i, chunk in enumerate(split_message(text)):
+        await target.send(chunk, first=(i == 0))
+
+class StreamingReply:
+    def __init__(self, target, edit_interval=1.0):
+        self.target = target
+        self.edit_interval = edit_interval
+        self.text = ''
+        self.sent = []
+        self.last_edit = 0.0
+
+    @property
+    def started(self):
+        return bool(self.sent)
+
+    # Posts new chunks as soon as they exist. Chunks that have been overflowed are
+    # complete and get their final edit right away; only the growing tail message
+    # is throttled to one edit per edit_interval to stay within Discord's limits.
+    async def update(self, text, final=False):
+        try:
+            await self._update(text, final)
+        except Exception as e:
+            raise DeliveryFailed(e) from e
+
+    async def _update(self, text, final):
+        chunks = split_message(text)
+        for i, chunk in enumerate(chunks):
+            now = time.monotonic()
+            if i >= len(self.sent):
+                sent = await self.target.send(chunk, first=(i == 0))
+                self.sent.append([sent, chunk])
+                self.last_edit = now
+                continue
+            sent, content = self.sent[i]
+            if content == chunk: continue
+            is_tail = i == len(chunks) - 1
+            if is_tail and not final and now - self.last_edit < self.edit_interval: continue
+            await self.target.edit(sent, chunk)
+            self.sent[i][1] = chunk
+            self.last_edit = now
+
+    async def feed(self, piece):
+        self.text += piece
+        await self.update(clean_reply(self.text))
+
+    async def finish(self):
+        await self.update(clean_reply(self.text), final=True)
@@ -3,10 +3,22 @@ from discord import app_commands
 import os
 import json
 import asyncio
+import functools
+import hashlib
+import time
 from cryptography.fernet import Fernet
 import firebase_admin
-from firebase_admin import credentials, firestore
-import google.generativeai as genai
+from firebase_admin import credentials, firestore, firestore_async
+from store import EvoStore, ServerConfigCache, WriteBehindBuffer, UserMemoryCache
+from llm import ModelPool, KeyHealthRegistry
+from scheduler import LLMScheduler, Overloaded
+from delivery import ReplyTarget, StreamingReply, DeliveryFailed, send_reply, clean_reply
+from shared_state import make_state_backend
+from memory import ConversationCache
+from metrics import registry, Trace, start_metrics_server, record_llm_call, MESSAGES, KEY_FAILOVERS, ERRORS, SCHEDULER_WAIT, RESPONSE_CACHE
+from usage import UsageLedger
+from response_cache import ResponseCache, normalize, personality_hash
+from reflection import ReflectionJob, ReflectionPool, ReflectionBatcher, parse_batch_response, is_worth_reflecting
 
 # ==================================================================================
 # 1. STARTUP SEQUENCE
@@ -32,6 +44,7 @@ try:
     cred = credentials.Certificate(cred_json)
     firebase_admin.initialize_app(cred)
     db = firestore.client()
+    async_db = firestore_async.client()
     print("Evo has successfully connected to Firebase.")
 except Exception as e:
     print(f"FATAL: Could not connect to Firebase: {e}")
@@ -44,6 +57,61 @@ try:
 except FileNotFoundError:
     print("FATAL: personality.json not found. The bot needs its base personality to function.")
     exit()
+DEFAULT_RULES = "\n".join(DEFAULT_PERSONALITY.get('system_prompt_components', {}).get('rules', []))
+
+# --- Sharding ---
+# SHARDED=true runs an AutoShardedClient. cluster.py sets SHARD_COUNT/SHARD_IDS to
+# give each worker process its own range, and CLUSTER_ID to tell them apart.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+SHARDED = os.getenv('SHARDED', '').lower() in ('1', 'true', 'yes') or SHARD_IDS is not None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', 0))
+
+# --- Startup ---
+# Nickname fixes on (re)connect are paced to NICK_EDIT_CONCURRENCY edits per NICK_EDIT_INTERVAL seconds
+NICK_EDIT_CONCURRENCY = int(os.getenv('NICK_EDIT_CONCURRENCY', 5))
+NICK_EDIT_INTERVAL = float(os.getenv('NICK_EDIT_INTERVAL', 1.0))
+
+# --- Data Layer ---
+store = EvoStore(
+    async_db,
+    ServerConfigCache(db.collection('server_configs'), DEFAULT_PERSONALITY.get('name', 'Evo'), SHARD_COUNT, SHARD_IDS),
+    WriteBehindBuffer(async_db, os.getenv('MEMORY_JOURNAL_PATH', 'memory_journal.jsonl'), flush_interval=float(os.getenv('MEMORY_FLUSH_INTERVAL', 5))),
+    UserMemoryCache(max_entries=int(os.getenv('USER_CACHE_SIZE', 5000)), ttl=float(os.getenv('USER_CACHE_TTL', 900)))
+)
+store.configs.start()
+
+# --- AI Clients ---
+state_backend = make_state_backend()
+model_pool = ModelPool(max_size=int(os.getenv('MODEL_POOL_SIZE', 256)))
+key_health = KeyHealthRegistry(open_seconds=float(os.getenv('KEY_COOLDOWN_SECONDS', 30)))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 60))
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 1500))
+HISTORY_SUMMARY_TOKENS = int(os.getenv('HISTORY_SUMMARY_TOKENS', 300))
+conversations = ConversationCache(max_entries=int(os.getenv('USER_CACHE_SIZE', 5000)), budget=HISTORY_TOKEN_BUDGET, summary_budget=HISTORY_SUMMARY_TOKENS)
+llm_scheduler = LLMScheduler(
+    max_in_flight=int(os.getenv('LLM_MAX_IN_FLIGHT', 16)),
+    max_queue=int(os.getenv('LLM_MAX_QUEUE', 200)),
+    max_guild_queue=int(os.getenv('LLM_GUILD_QUEUE', 10)),
+    guild_rate=float(os.getenv('LLM_GUILD_RATE', 0.5)),
+    guild_burst=int(os.getenv('LLM_GUILD_BURST', 5)),
+    max_wait=float(os.getenv('LLM_MAX_WAIT', 20)),
+    background_rate=float(os.getenv('LLM_BACKGROUND_RATE', 0.2)),
+    background_burst=int(os.getenv('LLM_BACKGROUND_BURST', 3))
+)
+usage_ledger = UsageLedger(
+    async_db,
+    flush_interval=float(os.getenv('USAGE_FLUSH_INTERVAL', 30)),
+    call_quota=int(os.getenv('USAGE_DAILY_CALL_QUOTA', 0)),
+    token_quota=int(os.getenv('USAGE_DAILY_TOKEN_QUOTA', 0))
+)
+response_cache = ResponseCache(
+    DEFAULT_PERSONALITY.get('greetings', []),
+    ttl=float(os.getenv('RESPONSE_CACHE_TTL', 120)),
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', 2000)),
+    max_words=int(os.getenv('RESPONSE_CACHE_MAX_WORDS', 12))
+)
 
 # --- Connect to Discord ---
 intents = discord.Intents.default()
@@ -51,77 +119,296 @@ intents.message_content = True
 intents.guilds = True
 intents.members = True
 
-class EvoClient(discord.Client):
-    def __init__(self, *, intents: discord.Intents):
-        super().__init__(intents=intents)
+class EvoClient(discord.AutoShardedClient if SHARDED else discord.Client):
+    def __init__(self, *, intents: discord.Intents, **options):
+        super().__init__(intents=intents, **options)
         self.tree = app_commands.CommandTree(self)
 
     async def setup_hook(self):
+        store.start()
+        usage_ledger.start()
+        reflections.start()
+        self.stats_task = asyncio.create_task(report_scheduler_stats())
+        self.state_task = asyncio.create_task(sync_shared_state())
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server(METRICS_PORT)
+        # Commands are global, so only the first cluster process needs to sync them
+        if CLUSTER_ID == 0:
+            await self.sync_commands()
+
+    # Syncing the tree is a global, heavily rate-limited call, so it only happens when
+    # the commands actually changed since the last sync.
+    async def sync_commands(self):
+        payload = json.dumps([command.to_dict(self.tree) for command in self.tree.get_commands()], sort_keys=True)
+        tree_hash = hashlib.sha256(payload.encode()).hexdigest()
+        try:
+            synced = await store.get_bot_state('command_tree')
+        except Exception as e:
+            print(f"Could not read the stored command tree hash. Syncing anyway. Error: {e}")
+            synced = {}
+        if synced.get('hash') == tree_hash:
+            print("Command tree unchanged, skipping sync.")
+            return
         await self.tree.sync()
+        print("Command tree synced.")
+        try:
+            await store.set_bot_state('command_tree', {'hash': tree_hash})
+        except Exception as e:
+            print(f"Could not store the command tree hash. The next start will sync again. Error: {e}")
+
+    async def close(self):
+        if self.is_closed(): return
+        if reflection_batcher: await reflection_batcher.flush_all()
+        await reflections.drain()
+        await usage_ledger.close()
+        await store.close()
+        await super().close()
+
+shard_options = {}
+if SHARDED:
+    if SHARD_COUNT: shard_options['shard_count'] = SHARD_COUNT
+    if SHARD_IDS: shard_options['shard_ids'] = SHARD_IDS
 
-bot = EvoClient(intents=intents)
+bot = EvoClient(intents=intents, **shard_options)
 
 # ==================================================================================
 # 2. HELPER FUNCTIONS
 # ==================================================================================
 
+# Keys only change when the dashboard saves new ones, so decrypted values are memoized
+@functools.lru_cache(maxsize=1024)
 def decrypt_key(encrypted_key):
     if not encrypted_key: return ""
     try: return cipher_suite.decrypt(encrypted_key.encode()).decode()
     except Exception: return ""
 
+# Cheap trigger-matching stage. Runs before anything else in on_message and only
+# touches cached state, so the vast majority of messages are rejected without I/O.
+def is_triggered(message, trigger):
+    if trigger.channel_id and str(message.channel.id) != trigger.channel_id: return False
+    if bot.user.mentioned_in(message): return True
+    reference = message.reference
+    if reference and reference.resolved and getattr(reference.resolved, 'author', None) == bot.user: return True
+    return trigger.name_pattern.search(message.content) is not None
+
+# Webhooks are cached per channel so custom-avatar replies need no lookup calls.
+# Entries are dropped on on_webhooks_update or when a send comes back 404.
+webhook_cache = {}
+
 async def get_or_create_webhook(channel):
+    webhook = webhook_cache.get(channel.id)
+    if webhook: return webhook
     webhooks = await channel.webhooks()
-    for webhook in webhooks:
-        if webhook.user == bot.user:
-            return webhook
-    return await channel.create_webhook(name=f"{bot.user.name}'s Webhook")
-
-async def update_summaries(model, memory_ref, user_name, conversation_exchange, old_personal_summary):
-    print(f"Starting personal summary reflection for user: {user_name}")
+    for candidate in webhooks:
+        if candidate.user == bot.user:
+            webhook = candidate
+            break
+    else:
+        webhook = await channel.create_webhook(name=f"{bot.user.name}'s Webhook")
+    webhook_cache[channel.id] = webhook
+    return webhook
+
+async def refresh_webhook(channel):
+    webhook_cache.pop(channel.id, None)
+    return await get_or_create_webhook(channel)
+
+# Every background LLM call goes through here: it waits for a slot in the
+# scheduler's background lane (never shed) and records latency and token usage.
+async def generate_reflection(model, server_id, prompt, purpose):
+    model_name = getattr(model, 'model_name', 'unknown').removeprefix('models/')
+    async with llm_scheduler.slot(server_id, shed=False):
+        started = time.perf_counter()
+        try:
+            response = await model.generate_content_async(prompt, request_options={'timeout': LLM_TIMEOUT})
+            text = response.text
+        except Exception:
+            record_llm_call(server_id, model_name, purpose, time.perf_counter() - started, outcome='error')
+            raise
+    record_llm_call(server_id, model_name, purpose, time.perf_counter() - started, response)
+    usage_ledger.record(server_id, purpose, response)
+    return text
+
+async def update_summaries(job):
+    print(f"Starting personal summary reflection for user: {job.user_name}")
     try:
+        user_memory = await store.get_user_memory(job.server_id, job.user_id)
+        old_personal_summary = user_memory.get('personal_summary', 'No summary available.')
+        conversation_exchange = ''.join(job.entries)
+
         personal_summary_prompt = f"""
         You are a memory assistant. Your job is to update a user summary based on a new conversation.
-        The user's name is {user_name}.
+        The user's name is {job.user_name}.
         Here is the old summary of the user: --- {old_personal_summary} ---
-        Here is the latest conversation exchange: --- {conversation_exchange} ---
+        Here are the latest conversation exchanges: --- {conversation_exchange} ---
         Based on this new information, provide an updated summary of the user. The summary should be a concise paragraph, written in the third person.
         Keep the summary under 200 words. If no new important personal information was learned, just return the original summary.
         """
-        personal_response = await model.generate_content_async(personal_summary_prompt)
-        new_personal_summary = personal_response.text
-        await asyncio.to_thread(memory_ref.set, {'personal_summary': new_personal_summary}, merge=True)
-        print(f"Successfully updated personal summary for {user_name}.")
+        new_personal_summary = await generate_reflection(job.model, job.server_id, personal_summary_prompt, 'personal_summary')
+        await store.update_user_memory(job.server_id, job.user_id, {'personal_summary': new_personal_summary})
+        print(f"Successfully updated personal summary for {job.user_name}.")
     except Exception as e:
-        print(f"Could not update personal summary for {user_name}. Error: {e}")
+        print(f"Could not update personal summary for {job.user_name}. Error: {e}")
 
-async def update_gossip_summary(model, server_id, mentioned_user, author_name, message_content):
-    print(f"Starting gossip reflection for mentioned user: {mentioned_user.display_name}")
+async def update_gossip_summary(job):
+    print(f"Starting gossip reflection for mentioned user: {job.user_name}")
     try:
-        gossip_memory_ref = db.collection('memories').document(server_id).collection('users').document(str(mentioned_user.id))
-        gossip_memory_doc = gossip_memory_ref.get()
-        gossip_memory = gossip_memory_doc.to_dict() if gossip_memory_doc.exists else {}
+        gossip_memory = await store.get_user_memory(job.server_id, job.user_id)
         old_gossip_summary = gossip_memory.get('gossip_summary', 'No gossip available.')
+        statements = "\n".join(f"'{author_name}': {message_content}" for author_name, message_content in job.entries)
 
         gossip_prompt = f"""
         You are a memory assistant. You are listening to a conversation.
-        The user '{author_name}' just said the following about '{mentioned_user.display_name}':
+        The following was just said about '{job.user_name}':
         ---
-        {message_content}
+        {statements}
         ---
-        Here is the old gossip summary you have about '{mentioned_user.display_name}':
+        Here is the old gossip summary you have about '{job.user_name}':
         ---
         {old_gossip_summary}
         ---
-        Based on what '{author_name}' said, provide an updated gossip summary for '{mentioned_user.display_name}'.
+        Based on what was said, provide an updated gossip summary for '{job.user_name}'.
         Keep the summary under 200 words. If no new important information was learned, just return the original summary.
         """
-        gossip_response = await model.generate_content_async(gossip_prompt)
-        new_gossip_summary = gossip_response.text
-        await asyncio.to_thread(gossip_memory_ref.set, {'gossip_summary': new_gossip_summary}, merge=True)
-        print(f"Successfully updated gossip summary for {mentioned_user.display_name}.")
+        new_gossip_summary = await generate_reflection(job.model, job.server_id, gossip_prompt, 'gossip_summary')
+        await store.update_user_memory(job.server_id, job.user_id, {'gossip_summary': new_gossip_summary})
+        print(f"Successfully updated gossip summary for {job.user_name}.")
+    except Exception as e:
+        print(f"Could not update gossip summary for {job.user_name}. Error: {e}")
+
+async def update_guild_summaries(batch):
+    print(f"Starting batched reflection for server {batch.server_id}: {len(batch.personal)} personal, {len(batch.gossip)} gossip")
+    try:
+        user_ids = list(set(batch.personal) | set(batch.gossip))
+        user_memories = await asyncio.gather(*(store.get_user_memory(batch.server_id, user_id) for user_id in user_ids))
+        memories = dict(zip(user_ids, user_memories))
+
+        sections = []
+        for user_id, job in batch.personal.items():
+            old_personal_summary = memories[user_id].get('personal_summary', 'No summary available.')
+            sections.append(f"[personal] id={user_id} name={job.user_name}\nOld summary: {old_personal_summary}\nLatest conversation exchanges:\n{''.join(job.entries)}")
+        for user_id, job in batch.gossip.items():
+            old_gossip_summary = memories[user_id].get('gossip_summary', 'No gossip available.')
+            statements = "\n".join(f"'{author_name}': {message_content}" for author_name, message_content in job.entries)
+            sections.append(f"[gossip] id={user_id} name={job.user_name}\nOld gossip summary: {old_gossip_summary}\nWhat others just said about them:\n{statements}")
+        entries = "\n\n".join(sections)
+
+        batch_prompt = f"""
+        You are a memory assistant. You keep summaries about the members of a Discord server.
+        Below are the users whose summaries may need updating. Each entry is marked [personal] (a summary of the user based on their own conversations)
+        or [gossip] (a summary of what other people say about the user).
+        ---
+        {entries}
+        ---
+        For each entry, provide an updated summary. Each summary should be a concise paragraph, written in the third person, under 200 words.
+        If no new important information was learned for an entry, leave it out.
+        Respond with only a JSON object of the form {{"personal": {{"<id>": "<summary>"}}, "gossip": {{"<id>": "<summary>"}}}}.
+        """
+        updates = parse_batch_response(await generate_reflection(batch.model, batch.server_id, batch_prompt, 'batch_summary'))
+
+        writes = []
+        for user_id in user_ids:
+            data = {}
+            if user_id in batch.personal and user_id in updates['personal']:
+                data['personal_summary'] = updates['personal'][user_id]
+            if user_id in batch.gossip and user_id in updates['gossip']:
+                data['gossip_summary'] = updates['gossip'][user_id]
+            if data: writes.append(store.update_user_memory(batch.server_id, user_id, data))
+        await asyncio.gather(*writes)
+        print(f"Successfully updated {len(writes)} summaries for server {batch.server_id}.")
+    except Exception as e:
+        print(f"Could not run batched reflection for server {batch.server_id}. Error: {e}")
+
+async def run_reflection(job):
+    trace = Trace('reflection', guild=job.server_id, kind=job.kind)
+    with trace.stage(f"reflection_{job.kind}"):
+        if job.kind == 'personal':
+            await update_summaries(job)
+        elif job.kind == 'gossip':
+            await update_gossip_summary(job)
+        elif job.kind == 'batch':
+            await update_guild_summaries(job)
+    trace.finish('done')
+
+reflections = ReflectionPool(
+    run_reflection,
+    workers=int(os.getenv('REFLECTION_WORKERS', 4)),
+    max_pending=int(os.getenv('REFLECTION_QUEUE_SIZE', 1000))
+)
+
+# REFLECTION_MODE=batch collects each guild's reflections over a window and runs them as one LLM call
+reflection_batcher = None
+if os.getenv('REFLECTION_MODE', 'immediate') == 'batch':
+    reflection_batcher = ReflectionBatcher(
+        reflections,
+        window=float(os.getenv('REFLECTION_BATCH_WINDOW', 60)),
+        max_entries=int(os.getenv('REFLECTION_BATCH_SIZE', 20))
+    )
+
+# --- Metrics ---
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+llm_scheduler.stats.on_wait = SCHEDULER_WAIT.observe
+registry.gauge('evo_llm_queue_depth', 'Requests waiting for an LLM scheduler slot.', lambda: {(): llm_scheduler.queued})
+registry.gauge('evo_llm_in_flight', 'LLM calls currently in flight.', lambda: {(): llm_scheduler.in_flight})
+registry.gauge('evo_llm_shed', 'Replies shed by the LLM scheduler since startup.', lambda: {(): llm_scheduler.stats.shed})
+registry.gauge('evo_reflection_queue_depth', 'Reflection jobs waiting for a worker.', lambda: {(): reflections.queue.qsize()})
+registry.gauge('evo_cached_server_configs', 'Server configs held by the snapshot cache.', lambda: {(): len(store.configs.configs)})
+registry.gauge('evo_cached_user_memories', 'User memory documents in the hot cache.', lambda: {(): len(store.users.entries)})
+registry.gauge('evo_unflushed_memory_writes', 'User documents waiting in the write-behind buffer.', lambda: {(): len(store.writes.pending)})
+
+# Logs queue depth and slot wait times for the LLM scheduler whenever it saw traffic
+async def report_scheduler_stats(interval=60):
+    last_granted = 0
+    while True:
+        await asyncio.sleep(interval)
+        stats = llm_scheduler.snapshot()
+        if stats['granted'] != last_granted or stats['queue_depth']:
+            print(f"LLM scheduler: {stats}")
+        last_granted = stats['granted']
+
+# Exchanges API key cooldowns with the other shard processes (a no-op on the local backend)
+async def sync_shared_state(interval=2):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await state_backend.publish_cooldowns(key_health.export_cooldowns())
+            key_health.import_cooldowns(await state_backend.fetch_cooldowns(time.time()))
+        except Exception as e:
+            print(f"Could not sync shared state. Error: {e}")
+
+async def queue_reflection(job):
+    if reflection_batcher: await reflection_batcher.submit(job)
+    else: await reflections.submit(job)
+
+# --- Startup Reconciliation ---
+# on_ready fires on every reconnect. Configs are loaded in one go, only guilds
+# whose nickname is actually wrong get an edit, and the edits run concurrently but
+# paced, so a reconnect with thousands of guilds neither blocks nor floods the API.
+reconcile_task = None
+
+async def reconcile_nickname(guild, server_config, limiter):
+    if server_config is not None:
+        desired_nick = server_config.get('custom_bot_name')
+    else:
+        # Point 1: If name is not changed (no config), set to Evo
+        desired_nick = "Evo"
+    if not desired_nick or guild.me.nick == desired_nick: return False
+    async with limiter:
+        try: await guild.me.edit(nick=desired_nick)
+        except discord.Forbidden: return False
+        except discord.HTTPException as e: print(f"Could not set nickname on server {guild.id}. Error: {e}")
+        await asyncio.sleep(NICK_EDIT_INTERVAL)
+    return True
+
+async def reconcile_guilds():
+    started = time.monotonic()
+    try:
+        server_configs = await store.load_server_configs()
     except Exception as e:
-        print(f"Could not update gossip summary for {mentioned_user.display_name}. Error: {e}")
+        print(f"Could not load server configs for startup reconciliation. Error: {e}")
+        return
+    limiter = asyncio.Semaphore(NICK_EDIT_CONCURRENCY)
+    results = await asyncio.gather(*(reconcile_nickname(guild, server_configs.get(str(guild.id)), limiter) for guild in bot.guilds))
+    print(f"Reconciled {len(bot.guilds)} guilds ({sum(results)} nickname changes) in {time.monotonic() - started:.1f}s.")
 
 # ==================================================================================
 # 3. SLASH COMMANDS
@@ -131,10 +418,9 @@ async def update_gossip_summary(model, server_id, mentioned_user, author_name, m
 @app_commands.default_permissions(administrator=True)
 async def evo_setup_check(interaction: discord.Interaction):
     server_id = str(interaction.guild.id)
-    server_ref = db.collection('server_configs').document(server_id)
-    server_doc = server_ref.get()
+    server_config = await store.get_server_config(server_id)
 
-    if server_doc.exists:
+    if server_config is not None:
         embed = discord.Embed(
             title="Evo is Ready!",
             description=f"Your bot is all set-up and ready to chat.\n\nYou can make changes to your bot's settings at any time on the [Evo Dashboard]({WEBSITE_URL}).",
@@ -156,121 +442,184 @@ async def evo_setup_check(interaction: discord.Interaction):
 @bot.event
 async def on_ready():
     print(f'Evo is online! Logged in as {bot.user}')
-    for guild in bot.guilds:
-        server_ref = db.collection('server_configs').document(str(guild.id))
-        server_doc = server_ref.get()
-        if server_doc.exists:
-            server_config = server_doc.to_dict()
-            bot_name = server_config.get('custom_bot_name')
-            if bot_name and guild.me.nick != bot_name:
-                try: await guild.me.edit(nick=bot_name)
-                except discord.Forbidden: pass
-        else:
-            # Point 1: If name is not changed (no config), set to Evo
-            if guild.me.nick != "Evo":
-                try: await guild.me.edit(nick="Evo")
-                except discord.Forbidden: pass
+    global reconcile_task
+    if reconcile_task and not reconcile_task.done(): return
+    reconcile_task = asyncio.create_task(reconcile_guilds())
+
+@bot.event
+async def on_webhooks_update(channel):
+    webhook_cache.pop(channel.id, None)
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user or not message.guild: return
 
     server_id = str(message.guild.id)
-    server_ref = db.collection('server_configs').document(server_id)
-    server_doc = server_ref.get()
-    
-    if not server_doc.exists: return
-
-    server_config = server_doc.to_dict()
-    bot_name = server_config.get('custom_bot_name', DEFAULT_PERSONALITY.get('name', 'Evo')).lower()
-
-    is_reply = message.reference and message.reference.resolved and message.reference.resolved.author == bot.user
-    is_mentioned = bot.user.mentioned_in(message)
-    is_name_called = bot_name in message.content.lower()
-
-    if not (is_reply or is_mentioned or is_name_called): return
-
-    designated_channel = server_config.get('designated_channel')
-    if designated_channel and designated_channel != 'all' and str(message.channel.id) != designated_channel: return
+    trigger = store.configs.triggers.get(server_id)
+    if trigger is None or not is_triggered(message, trigger):
+        MESSAGES.inc(result='ignored')
+        return
+
+    server_config = store.configs.get(server_id)
+    if server_config is None: return
+
+    await usage_ledger.load(server_id)
+    over_quota = usage_ledger.over_quota(server_id, server_config)
+    if over_quota:
+        MESSAGES.inc(result='over_quota')
+        if usage_ledger.notify_once(server_id):
+            print(f"Server {server_id} hit its daily quota ({over_quota}).")
+            await message.reply(DEFAULT_PERSONALITY.get('quota_reply', "I've hit my daily limit on this server. I'll be back tomorrow!"))
+        return
+    MESSAGES.inc(result='triggered')
+    trace = Trace('message', guild=server_id)
+    outcome = 'replied'
 
     async with message.channel.typing():
         try:
             user_id = str(message.author.id)
-            memory_ref = db.collection('memories').document(server_id).collection('users').document(user_id)
-            memory_doc = memory_ref.get()
-            user_memory = memory_doc.to_dict() if memory_doc.exists else {}
+            with trace.stage('memory_read'):
+                user_memory = await store.get_user_memory(server_id, user_id)
             
-            conversation_history = user_memory.get('conversation_history', [])
+            conversation = conversations.get((server_id, user_id), user_memory)
+            history_summary, recent_history = conversation.render()
             personal_summary = user_memory.get('personal_summary', 'No summary available.')
             
             final_personality = server_config.get('custom_personality') or DEFAULT_PERSONALITY.get('system_prompt_components', {}).get('personality')
-            rules = "\n".join(DEFAULT_PERSONALITY.get('system_prompt_components', {}).get('rules', []))
             
             # Point 3: Inject the name separately
             name_instruction = f"You are {server_config.get('custom_bot_name', 'Evo')}."
-            system_instruction = f"{name_instruction}\n{final_personality}\n\n{rules}"
+            system_instruction = f"{name_instruction}\n{final_personality}\n\n{DEFAULT_RULES}"
             
             prompt = f"""
             Here is a summary of what you know about the user '{message.author.display_name}':
             {personal_summary}
+            Earlier in your conversation with this user (condensed):
+            {history_summary}
             Recent conversation history (user messages are prefixed with 'User:', your responses with 'AI:'):
-            {''.join(conversation_history)}
+            {recent_history}
             Now, respond to this new message from the user:
             User: {message.clean_content}
             """
 
             api_key = decrypt_key(server_config.get('encrypted_api_key', ''))
             backup_api_key = decrypt_key(server_config.get('encrypted_backup_api_key', ''))
+            model_name = server_config.get('ai_model') or 'gemini-pro'
             ai_response_text = None
             model = None
 
-            for key in [api_key, backup_api_key]:
-                if not key: continue
+            custom_avatar_url = server_config.get('custom_avatar_url')
+            if custom_avatar_url:
+                with trace.stage('webhook_lookup'):
+                    webhook = await get_or_create_webhook(message.channel)
+                target = ReplyTarget(message, webhook, server_config.get('custom_bot_name') or bot.user.name, custom_avatar_url, refresh_webhook=lambda: refresh_webhook(message.channel))
+            else:
+                target = ReplyTarget(message)
+            streamed = None
+
+            # Opt-in: canned greetings and recently generated replies skip the LLM entirely
+            cache_key = None
+            if server_config.get('response_cache'):
+                with trace.stage('response_cache'):
+                    normalized = normalize(message.clean_content, server_config.get('custom_bot_name') or DEFAULT_PERSONALITY.get('name', 'Evo'))
+                    ai_response_text = response_cache.greeting_for(normalized, message.author.display_name)
+                    if ai_response_text:
+                        RESPONSE_CACHE.inc(result='greeting')
+                    else:
+                        mentions_others = any(user != bot.user for user in message.mentions)
+                        cache_key = response_cache.key(server_id, personality_hash(model_name, system_instruction), normalized, mentions_others)
+                        if cache_key:
+                            ai_response_text = response_cache.get(cache_key)
+                            RESPONSE_CACHE.inc(result='hit' if ai_response_text else 'miss')
+                if ai_response_text: outcome = 'cached'
+
+            # A reply that may be served to other members is generated without anything
+            # about the asker (name, summary or history), so it cannot leak any of it
+            if cache_key:
+                prompt = f"""
+            Respond to this new message from a member of the server:
+            User: {message.clean_content}
+            """
+
+            if not ai_response_text:
                 try:
-                    genai.configure(api_key=key)
-                    model = genai.GenerativeModel(
-                        model_name=server_config.get('ai_model', 'gemini-pro'),
-                        system_instruction=system_instruction
-                    )
-                    response = await model.generate_content_async(prompt)
-                    ai_response_text = response.text
-                    break
-                except Exception as e:
-                    print(f"AI API call failed with a key. Trying next one. Error: {e}")
+                    async with llm_scheduler.slot(server_id):
+                        for attempt, key in enumerate(key_health.usable([api_key, backup_api_key])):
+                            if attempt: KEY_FAILOVERS.inc(guild=server_id)
+                            health = key_health.get(key)
+                            started = time.perf_counter()
+                            try:
+                                model = model_pool.get(key, model_name, system_instruction)
+                                # With streaming on, this stage also covers posting and editing the reply
+                                with trace.stage('llm_generate'):
+                                    if server_config.get('streaming_replies'):
+                                        streamed = StreamingReply(target, edit_interval=STREAM_EDIT_INTERVAL)
+                                        response = await model.generate_content_async(prompt, stream=True, request_options={'timeout': LLM_TIMEOUT})
+                                        async for chunk in response:
+                                            await streamed.feed(chunk.text)
+                                        await streamed.finish()
+                                        ai_response_text = streamed.text
+                                    else:
+                                        response = await model.generate_content_async(prompt, request_options={'timeout': LLM_TIMEOUT})
+                                        ai_response_text = response.text
+                                record_llm_call(server_id, model_name, 'reply', time.perf_counter() - started, response)
+                                usage_ledger.record(server_id, 'reply', response)
+                                health.record_success()
+                                if cache_key: response_cache.put(cache_key, ai_response_text, message.author.display_name)
+                                break
+                            except DeliveryFailed as e:
+                                # Discord rejected the reply, not the model. No failover: the send
+                                # may have gone through, and regenerating could answer twice.
+                                record_llm_call(server_id, model_name, 'reply', time.perf_counter() - started, outcome='delivery_error')
+                                health.record_success()
+                                print(f"Could not deliver the streamed reply on server {server_id}. Error: {e}")
+                                outcome = 'delivery_error'
+                                ERRORS.inc(stage='delivery')
+                                return
+                            except Exception as e:
+                                record_llm_call(server_id, model_name, 'reply', time.perf_counter() - started, outcome='error')
+                                health.record_failure(e)
+                                print(f"AI API call failed with a key (circuit {health.state}). Trying next one. Error: {e}")
+                                if streamed and streamed.started:
+                                    # Part of the reply is already posted, so keep it rather than answering twice
+                                    await streamed.finish()
+                                    ai_response_text = streamed.text
+                                    break
+                except Overloaded as e:
+                    print(f"Shedding message on server {server_id}: {e}")
+                    outcome = 'shed'
+                    await message.reply(DEFAULT_PERSONALITY.get('busy_reply', "I'm a little overwhelmed right now, try again in a moment!"))
+                    return
             
             if not ai_response_text:
+                outcome = 'no_response'
+                ERRORS.inc(stage='llm')
                 await message.reply("I'm having trouble connecting to my brain right now. Please check my API key configuration on the website.")
                 return
 
-            reply_to_user = ai_response_text
-            if reply_to_user.lower().strip().startswith('ai:'):
-                reply_to_user = reply_to_user.strip()[3:].lstrip()
-
-            custom_avatar_url = server_config.get('custom_avatar_url')
-            if custom_avatar_url:
-                webhook = await get_or_create_webhook(message.channel)
-                await webhook.send(
-                    content=reply_to_user,
-                    username=server_config.get('custom_bot_name', bot.user.name),
-                    avatar_url=custom_avatar_url
-                )
-            else:
-                await message.reply(reply_to_user)
+            if not streamed:
+                with trace.stage('delivery'):
+                    await send_reply(target, clean_reply(ai_response_text))
 
             latest_exchange = f"User: {message.clean_content}\nAI: {ai_response_text}\n"
-            new_history = conversation_history + [latest_exchange]
+            conversation.append(latest_exchange)
             
-            await asyncio.to_thread(memory_ref.set, {'conversation_history': new_history[-10:]}, merge=True)
+            with trace.stage('history_write'):
+                history_doc = conversation.to_doc()
+                await store.update_user_memory(server_id, user_id, history_doc)
+                conversations.put((server_id, user_id), conversation, history_doc)
             
             if model:
-                # Update personal summary for the author
-                await update_summaries(model, memory_ref, message.author.display_name, latest_exchange, personal_summary)
-                
-                # Point 2: Update gossip summary for mentioned users
-                if message.mentions:
-                    for mentioned_user in message.mentions:
-                        if mentioned_user != bot.user:
-                            await update_gossip_summary(model, server_id, mentioned_user, message.author.display_name, message.clean_content)
+                with trace.stage('reflection_enqueue'):
+                    # Queue the personal summary update for the author; the worker pool runs it off the reply path
+                    if is_worth_reflecting(message.clean_content):
+                        await queue_reflection(ReflectionJob('personal', model, server_id, user_id, message.author.display_name, [latest_exchange]))
+                    
+                    # Point 2: Update gossip summary for mentioned users
+                    if is_worth_reflecting(message.clean_content, personal=False):
+                        for mentioned_user in message.mentions:
+                            if mentioned_user != bot.user:
+                                await queue_reflection(ReflectionJob('gossip', model, server_id, str(mentioned_user.id), mentioned_user.display_name, [(message.author.display_name, message.clean_content)]))
             
             new_name = server_config.get('custom_bot_name')
             if new_name and message.guild.me.nick != new_name:
@@ -278,8 +627,12 @@ async def on_message(message):
                 except discord.Forbidden: print(f"Could not change nickname on server {server_id}. Missing permissions.")
 
         except Exception as e:
+            outcome = 'error'
+            ERRORS.inc(stage='on_message')
             print(f"An unexpected error occurred in on_message: {e}")
             await message.reply("Something went very wrong while I was thinking. My apologies!")
+        finally:
+            trace.finish(outcome, model=server_config.get('ai_model') or 'gemini-pro')
 
 # ==================================================================================
 # 5. RUN THE BOT
@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict, deque
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core import client_options as client_options_lib
+from google.api_core import exceptions as google_exceptions
+
+# ==================================================================================
+# GEMINI CLIENTS
+# genai.configure() sets one process-wide API key, which is both slow to redo per
+# message and a race when guilds with different keys reply at the same time.
+# Instead each key gets its own async client, and models are pooled on top of them.
+# ==================================================================================
+
+class ModelPool:
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.clients = {}
+        self.client_refs = {}
+
+    def _client_for(self, api_key):
+        client = self.clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceAsyncClient(client_options=client_options_lib.ClientOptions(api_key=api_key))
+            self.clients[api_key] = client
+            self.client_refs[api_key] = 0
+        self.client_refs[api_key] += 1
+        return client
+
+    def _release_client(self, api_key):
+        self.client_refs[api_key] -= 1
+        if self.client_refs[api_key] <= 0:
+            del self.client_refs[api_key]
+            del self.clients[api_key]
+
+    # Returns a GenerativeModel bound to api_key. Models are safe to share between
+    # concurrent requests; the least recently used one is dropped when the pool is full.
+    def get(self, api_key, model_name, system_instruction):
+        key = (api_key, model_name, system_instruction)
+        model = self.models.get(key)
+        if model is not None:
+            self.models.move_to_end(key)
+            return model
+
+        model = genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+        # GenerativeModel lazily falls back to the global client when this is unset,
+        # so pinning it here is what keeps each key isolated.
+        model._async_client = self._client_for(api_key)
+        self.models[key] = model
+
+        while len(self.models) > self.max_size:
+            (evicted_key, _, _), _ = self.models.popitem(last=False)
+            self._release_client(evicted_key)
+        return model
+
+# ==================================================================================
+# API KEY HEALTH
+# Tracks recent results per key so a dead or rate-limited primary key is skipped
+# instead of costing every message a full timeout before the backup is tried.
+# ==================================================================================
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+def is_rate_limited(error):
+    return isinstance(error, google_exceptions.ResourceExhausted) or getattr(error, 'code', None) == 429
+
+def is_key_failure(error):
+    return isinstance(error, (google_exceptions.GoogleAPICallError, asyncio.TimeoutError))
+
+# Gemini sends the wait either as a google.rpc.RetryInfo detail or in the message text.
+def retry_after_from(error, default=30.0):
+    for detail in getattr(error, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None and (retry_delay.seconds or retry_delay.nanos):
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    match = re.search(r"retry in ([\d.]+)s|retry_delay\s*\{\s*seconds:\s*(\d+)", str(error), re.IGNORECASE)
+    if match: return float(match.group(1) or match.group(2))
+    return default
+
+class KeyHealth:
+    def __init__(self, window=20, min_calls=5, failure_rate=0.5, consecutive_failures=3, open_seconds=30, max_open_seconds=600):
+        self.results = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.consecutive_failures = consecutive_failures
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.streak = 0
+        self.probing = False
+
+    # Closed keys always pass. An open key becomes half-open once its cooldown has
+    # passed and then lets exactly one probe request through at a time.
+    def try_acquire(self, now=None):
+        now = now or time.monotonic()
+        if self.state == OPEN:
+            if now < self.open_until: return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probing: return False
+            self.probing = True
+        return True
+
+    def record_success(self):
+        self.results.append(True)
+        self.streak = 0
+        self.probing = False
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.open_seconds = self.base_open_seconds
+
+    def record_failure(self, error):
+        self.probing = False
+        now = time.monotonic()
+        if is_rate_limited(error):
+            # Quota errors say nothing about the key being broken, just honor the wait.
+            self._open(now, retry_after_from(error, self.base_open_seconds))
+            return
+        if not is_key_failure(error): return
+
+        self.results.append(False)
+        self.streak += 1
+        if self.state == HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+            self._open(now, self.open_seconds)
+            return
+        failures = self.results.count(False)
+        if self.streak >= self.consecutive_failures or (len(self.results) >= self.min_calls and failures / len(self.results) >= self.failure_rate):
+            self._open(now, self.open_seconds)
+
+    def _open(self, now, seconds):
+        self.state = OPEN
+        self.open_until = max(self.open_until, now + seconds)
+
+    # Applies a cooldown another shard process saw for this key.
+    def hold_open(self, until):
+        if until > self.open_until:
+            self.state = OPEN
+            self.open_until = until
+
+def key_fingerprint(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+class KeyHealthRegistry:
+    def __init__(self, **health_options):
+        self.health_options = health_options
+        self.keys = {}
+        self.fingerprints = {}
+
+    def get(self, api_key):
+        health = self.keys.get(api_key)
+        if health is None:
+            health = self.keys[api_key] = KeyHealth(**self.health_options)
+            self.fingerprints[key_fingerprint(api_key)] = api_key
+        return health
+
+    # Open circuits are shared with other shard processes by key fingerprint (never
+    # the key itself) as wall-clock deadlines, since monotonic clocks are per machine.
+    def export_cooldowns(self):
+        now, wall_now = time.monotonic(), time.time()
+        cooldowns = {}
+        for fingerprint, api_key in self.fingerprints.items():
+            health = self.keys[api_key]
+            if health.state == OPEN and health.open_until > now:
+                cooldowns[fingerprint] = wall_now + (health.open_until - now)
+        return cooldowns
+
+    def import_cooldowns(self, cooldowns):
+        now, wall_now = time.monotonic(), time.time()
+        for fingerprint, until in cooldowns.items():
+            api_key = self.fingerprints.get(fingerprint)
+            if api_key: self.keys[api_key].hold_open(now + (until - wall_now))
+
+    # Keeps the configured primary/backup order but leaves out keys whose circuit is open.
+    def usable(self, api_keys):
+        seen = set()
+        for api_key in api_keys:
+            if not api_key or api_key in seen: continue
+            seen.add(api_key)
+            if self.get(api_key).try_acquire():
+                yield api_key
@@ -0,0 +1,113 @@
+# ==================================================================================
+# CONVERSATION MEMORY
+# Keeps a user's recent exchanges under a token budget instead of a fixed number
+# of turns. Turns that fall out of the budget are folded into a short running
+# summary, and the prompt section is rendered once and reused until it changes.
+# ==================================================================================
+
+from collections import OrderedDict
+
+CHARS_PER_TOKEN = 4
+
+# A rough count is all we need for budgeting, and it costs nothing compared to
+# asking the API to count tokens on every message.
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def clip(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars: return text
+    return text[:max_chars].rstrip() + "…"
+
+# Turns are stored as "User: ...\nAI: ...\n". Folding one keeps the gist of each
+# side as a single line of the running summary.
+def digest(turn, max_tokens=40):
+    user_part, _, ai_part = turn.partition("\nAI:")
+    user_part = user_part.replace("User:", "", 1).strip()
+    ai_part = ai_part.strip()
+    side = max(max_tokens // 2, 1)
+    return f"- They said: {clip(' '.join(user_part.split()), side)} / You said: {clip(' '.join(ai_part.split()), side)}"
+
+class ConversationMemory:
+    def __init__(self, turns=None, summary='', budget=1500, summary_budget=300):
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.turns = []
+        self.turn_tokens = []
+        self.total_tokens = 0
+        self.summary = summary or ''
+        self._rendered = None
+        for turn in turns or []:
+            self._add(turn)
+        self._fold()
+
+    @classmethod
+    def from_doc(cls, user_memory, budget=1500, summary_budget=300):
+        return cls(user_memory.get('conversation_history', []), user_memory.get('history_summary', ''), budget, summary_budget)
+
+    def _add(self, turn):
+        # No single exchange may take more than the whole budget on its own
+        turn = clip(turn, self.budget)
+        tokens = estimate_tokens(turn)
+        self.turns.append(turn)
+        self.turn_tokens.append(tokens)
+        self.total_tokens += tokens
+        return turn
+
+    # Moves the oldest turns into the summary until the rest fits, always keeping
+    # the newest turn, then drops the oldest summary lines if it outgrew its own budget.
+    def _fold(self):
+        folded = False
+        while len(self.turns) > 1 and self.total_tokens > self.budget:
+            turn = self.turns.pop(0)
+            self.total_tokens -= self.turn_tokens.pop(0)
+            self.summary = f"{self.summary}\n{digest(turn)}".strip()
+            folded = True
+        if folded:
+            lines = self.summary.split("\n")
+            while len(lines) > 1 and estimate_tokens("\n".join(lines)) > self.summary_budget:
+                lines.pop(0)
+            self.summary = "\n".join(lines)
+        return folded
+
+    def append(self, exchange):
+        turn = self._add(exchange)
+        if self._fold() or self._rendered is None:
+            self._rendered = None
+        else:
+            # Nothing was folded, so the cached history text just grows at the end
+            self._rendered = (self._rendered[0], self._rendered[1] + turn)
+
+    # Returns (condensed summary, recent history) ready to drop into the prompt.
+    def render(self):
+        if self._rendered is None:
+            self._rendered = (self.summary or 'Nothing yet.', ''.join(self.turns))
+        return self._rendered
+
+    def to_doc(self):
+        return {'conversation_history': list(self.turns), 'history_summary': self.summary}
+
+# Keeps each active user's ConversationMemory between messages so its rendered
+# prompt pieces carry over. An entry is only reused while the user document still
+# holds the exact history list it wrote; any other write to the document, or a
+# fresh read after the user cache dropped it, brings a new list and a rebuild.
+class ConversationCache:
+    def __init__(self, max_entries=5000, budget=1500, summary_budget=300):
+        self.max_entries = max_entries
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.entries = OrderedDict()
+
+    def get(self, key, user_memory):
+        entry = self.entries.get(key)
+        history = user_memory.get('conversation_history')
+        if entry is not None and history is not None and entry[0] is history:
+            self.entries.move_to_end(key)
+            return entry[1]
+        return ConversationMemory.from_doc(user_memory, self.budget, self.summary_budget)
+
+    def put(self, key, conversation, doc):
+        self.entries[key] = (doc['conversation_history'], conversation)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
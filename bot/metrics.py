@@ -0,0 +1,178 @@
+import json
+import os
+import time
+import contextlib
+from aiohttp import web
+
+# ==================================================================================
+# METRICS & TRACING
+# In-process counters and histograms, served in Prometheus text format on
+# METRICS_PORT, plus one structured JSON log line per traced message when
+# METRICS_JSON_LOGS is on. Recording is a perf_counter() call and a dict update,
+# cheap enough to leave on in production.
+# ==================================================================================
+
+JSON_LOGS = os.getenv('METRICS_JSON_LOGS', '').lower() in ('1', 'true', 'yes')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs: return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+class Gauge:
+    kind = 'gauge'
+
+    # Gauges are read at scrape time from a callback returning {labels tuple: value}.
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+
+    def render(self):
+        for key, value in self.collect().items():
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}"
+            yield f"{self.name}_sum{_format_labels(key)} {total}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, collect):
+        metric = Gauge(name, help_text, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# --- Pipeline Metrics ---
+STAGE_SECONDS = registry.histogram('evo_stage_seconds', 'Time spent in each on_message / reflection stage.')
+MESSAGES = registry.counter('evo_messages_total', 'Messages seen by on_message, by result.')
+KEY_FAILOVERS = registry.counter('evo_key_failovers_total', 'Gemini calls that failed on one key and moved to the next.')
+ERRORS = registry.counter('evo_errors_total', 'Errors, by stage.')
+LLM_CALLS = registry.counter('evo_llm_calls_total', 'Gemini calls, by guild, model, purpose and outcome.')
+LLM_TOKENS = registry.counter('evo_llm_tokens_total', 'Gemini tokens used, by guild, model and kind.')
+LLM_SECONDS = registry.histogram('evo_llm_seconds', 'Gemini call latency, by model and purpose.')
+LLM_GUILD_SECONDS = registry.counter('evo_llm_guild_seconds_total', 'Total Gemini call time per guild (divide by evo_llm_calls_total for the mean).')
+RESPONSE_CACHE = registry.counter('evo_response_cache_total', 'Response cache lookups for opted-in guilds, by result (greeting, hit, miss).')
+SCHEDULER_WAIT = registry.histogram('evo_scheduler_wait_seconds', 'Time spent waiting for an LLM scheduler slot.')
+
+def log_event(event, **fields):
+    if JSON_LOGS:
+        print(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, default=str))
+
+def record_llm_call(server_id, model_name, purpose, seconds, response=None, outcome='ok'):
+    LLM_CALLS.inc(guild=server_id, model=model_name, purpose=purpose, outcome=outcome)
+    LLM_SECONDS.observe(seconds, model=model_name, purpose=purpose)
+    LLM_GUILD_SECONDS.inc(seconds, guild=server_id)
+    usage = getattr(response, 'usage_metadata', None) if response is not None else None
+    if usage:
+        LLM_TOKENS.inc(getattr(usage, 'prompt_token_count', 0) or 0, guild=server_id, model=model_name, kind='prompt')
+        LLM_TOKENS.inc(getattr(usage, 'candidates_token_count', 0) or 0, guild=server_id, model=model_name, kind='output')
+
+class Trace:
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + elapsed
+            STAGE_SECONDS.observe(elapsed, stage=stage_name)
+
+    def finish(self, outcome, **fields):
+        total = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(total, stage=f"{self.name}_total")
+        log_event(self.name, outcome=outcome, total_ms=round(total * 1000, 2),
+                  stages_ms={name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+                  **self.fields, **fields)
+
+# --- Endpoint ---
+async def start_metrics_server(port, host='0.0.0.0'):
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics endpoint listening on :{port}/metrics")
+    return runner
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import re
+
+# ==================================================================================
+# REFLECTION WORKER POOL
+# Personal and gossip summary updates are full LLM round trips, so they run here,
+# off the reply path, on a fixed number of workers fed by a bounded queue.
+# ==================================================================================
+
+class ReflectionJob:
+    # kind is 'personal' (entries are exchange strings) or 'gossip'
+    # (entries are (author_name, message_content) pairs about the user).
+    def __init__(self, kind, model, server_id, user_id, user_name, entries):
+        self.kind = kind
+        self.model = model
+        self.server_id = server_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.entries = list(entries)
+
+    @property
+    def key(self):
+        return (self.kind, self.server_id, self.user_id)
+
+    # Back-to-back jobs for the same user collapse into one reflection call.
+    def merge(self, other):
+        self.entries.extend(other.entries)
+        self.model = other.model
+        self.user_name = other.user_name
+
+# --- Batching ---
+# In batch mode jobs are collected per guild over a time or count window and the
+# whole guild is reflected on with one structured prompt instead of one per user.
+class GuildBatch:
+    kind = 'batch'
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.model = None
+        self.personal = {}
+        self.gossip = {}
+        self.size = 0
+
+    @property
+    def key(self):
+        return (self.kind, self.server_id, None)
+
+    def add(self, job):
+        self.model = job.model
+        bucket = self.personal if job.kind == 'personal' else self.gossip
+        queued = bucket.get(job.user_id)
+        if queued is not None: queued.merge(job)
+        else: bucket[job.user_id] = job
+        self.size += len(job.entries)
+
+    def merge(self, other):
+        for job in list(other.personal.values()) + list(other.gossip.values()):
+            self.add(job)
+
+class ReflectionBatcher:
+    def __init__(self, pool, window=60, max_entries=20):
+        self.pool = pool
+        self.window = window
+        self.max_entries = max_entries
+        self.batches = {}
+        self.timers = {}
+        self.flushing = set()
+
+    async def submit(self, job):
+        batch = self.batches.get(job.server_id)
+        if batch is None:
+            batch = self.batches[job.server_id] = GuildBatch(job.server_id)
+            self.timers[job.server_id] = asyncio.get_running_loop().call_later(self.window, self._on_timer, job.server_id)
+        batch.add(job)
+        if batch.size >= self.max_entries:
+            await self.flush(job.server_id)
+
+    def _on_timer(self, server_id):
+        task = asyncio.create_task(self.flush(server_id))
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self, server_id):
+        timer = self.timers.pop(server_id, None)
+        if timer: timer.cancel()
+        batch = self.batches.pop(server_id, None)
+        if batch: await self.pool.submit(batch)
+
+    async def flush_all(self):
+        for server_id in list(self.batches):
+            await self.flush(server_id)
+        if self.flushing:
+            await asyncio.gather(*self.flushing, return_exceptions=True)
+
+# Pulls {"personal": {...}, "gossip": {...}} out of a batch reflection reply,
+# tolerating code fences or chatter around the JSON object.
+def parse_batch_response(text):
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match: return {'personal': {}, 'gossip': {}}
+    data = json.loads(match.group(0))
+    return {
+        'personal': {str(k): v for k, v in (data.get('personal') or {}).items() if isinstance(v, str) and v.strip()},
+        'gossip': {str(k): v for k, v in (data.get('gossip') or {}).items() if isinstance(v, str) and v.strip()},
+    }
+
+# --- Relevance Heuristic ---
+# A cheap local check run before queueing anything. Short exchanges with no
+# self-disclosure ("lol", "hi evo") never change a summary, so they are skipped.
+SELF_REFERENCE = re.compile(r"\b(i|i'm|im|i've|ive|i'd|i'll|my|me|mine|myself)\b", re.IGNORECASE)
+MIN_REFLECTION_WORDS = 4
+
+def is_worth_reflecting(text, personal=True):
+    words = re.sub(r"[<@!>#&]\S*", " ", text).split()
+    if len(words) < MIN_REFLECTION_WORDS: return False
+    if personal: return SELF_REFERENCE.search(text) is not None
+    return True
+
+class ReflectionPool:
+    def __init__(self, handler, workers=4, max_pending=1000):
+        self.handler = handler
+        self.worker_count = workers
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.pending = {}
+        self.tasks = []
+        self.closing = False
+
+    def start(self):
+        if self.tasks: return
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    # While a job for the same key is still waiting in the queue the new entries are
+    # merged into it. Otherwise the job is queued, waiting for room if the queue is
+    # full so a flood of messages slows producers down instead of growing memory.
+    async def submit(self, job):
+        if self.closing: return
+        queued = self.pending.get(job.key)
+        if queued is not None:
+            queued.merge(job)
+            return
+        self.pending[job.key] = job
+        await self.queue.put(job.key)
+
+    async def _worker(self):
+        while True:
+            key = await self.queue.get()
+            job = self.pending.pop(key, None)
+            try:
+                if job: await self.handler(job)
+            except Exception as e:
+                print(f"Reflection job {key} failed. Error: {e}")
+            finally:
+                self.queue.task_done()
+
+    # Stop accepting work, let the workers finish what is already queued, then stop them.
+    async def drain(self, timeout=30):
+        self.closing = True
+        if self.pending:
+            print(f"Draining {len(self.pending)} pending reflection jobs...")
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Reflection drain timed out with {len(self.pending)} jobs left.")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
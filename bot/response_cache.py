@@ -0,0 +1,69 @@
+import re
+import time
+import random
+import hashlib
+from collections import OrderedDict
+from reflection import SELF_REFERENCE
+
+# ==================================================================================
+# RESPONSE CACHE
+# For guilds that opt in (response_cache in their config), two cheap tiers run
+# before the LLM:
+#   greeting - a bare name call or hello ("evo", "hi evo!") gets one of the canned
+#              greetings from personality.json
+#   exact    - the same short message, to the same personality, within a short
+#              TTL gets the reply that was generated for it the first time
+# Only short messages without other mentions are cached, since those are the ones
+# that repeat and whose answer does not depend on who asked. Anything about the
+# asker ("what's my name?") or about what was said before ("do you remember...")
+# is never cached, and cacheable messages are answered from a prompt without the
+# asker's name, summary or history. A reply that still names the asker is not kept.
+# ==================================================================================
+
+GREETING_WORDS = {'hi', 'hey', 'heya', 'hello', 'hiya', 'yo', 'sup', 'wassup', 'howdy', 'hola', 'gm', 'there', 'oi'}
+NON_WORD = re.compile(r"[^\w\s]+")
+MEMORY_REFERENCE = re.compile(r"\b(remember|recall|forgot|forget|know about|earlier|before|last time|again|we|us|our|ours|ourselves)\b")
+
+def normalize(text, bot_name):
+    text = re.sub(re.escape(bot_name), ' ', text, flags=re.IGNORECASE)
+    return ' '.join(NON_WORD.sub(' ', text.lower()).split())
+
+def personality_hash(model_name, system_instruction):
+    return hashlib.sha1(f"{model_name}\n{system_instruction}".encode()).hexdigest()
+
+def is_greeting(normalized):
+    return all(word in GREETING_WORDS for word in normalized.split())
+
+class ResponseCache:
+    def __init__(self, greetings, ttl=120, max_entries=2000, max_words=12):
+        self.greetings = greetings
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_words = max_words
+        self.entries = OrderedDict()
+
+    def greeting_for(self, normalized, user_name):
+        if not self.greetings or not is_greeting(normalized): return None
+        return random.choice(self.greetings).replace('{user}', user_name)
+
+    # None when the message should not be cached at all.
+    def key(self, server_id, persona, normalized, mentions_others):
+        if mentions_others or not normalized or len(normalized.split()) > self.max_words: return None
+        if SELF_REFERENCE.search(normalized) or MEMORY_REFERENCE.search(normalized): return None
+        return (server_id, persona, normalized)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None: return None
+        expires_at, text = entry
+        if time.monotonic() >= expires_at:
+            del self.entries[key]
+            return None
+        return text
+
+    def put(self, key, text, user_name=None):
+        if user_name and user_name.lower() in text.lower(): return
+        self.entries[key] = (time.monotonic() + self.ttl, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict, deque
+
+# ==================================================================================
+# LLM SCHEDULER
+# Every Gemini call takes a slot from here. A global cap bounds how many calls are
+# in flight, each guild refills its own token bucket, and waiting guilds are served
+# round-robin so one raid or spam burst cannot starve everybody else.
+# ==================================================================================
+
+class Overloaded(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available (0 if one is available now).
+    def time_until_token(self, now):
+        self._refill(now)
+        if self.tokens >= 1: return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class SchedulerStats:
+    def __init__(self, sample_size=1000):
+        self.granted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.waits = deque(maxlen=sample_size)
+        self.on_wait = None
+
+    def record_wait(self, seconds):
+        self.granted += 1
+        self.waits.append(seconds)
+        if self.on_wait: self.on_wait(seconds)
+
+    def wait_percentile(self, percentile):
+        if not self.waits: return 0.0
+        ordered = sorted(self.waits)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+# One class of work: its waiting guilds in round-robin order and a token bucket per guild.
+class Lane:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.waiting = OrderedDict()
+        self.buckets = {}
+        self.queued = 0
+
+    def bucket(self, guild_id):
+        bucket = self.buckets.get(guild_id)
+        if bucket is None:
+            bucket = self.buckets[guild_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def forget(self, guild_id, future):
+        queue = self.waiting.get(guild_id)
+        if queue and future in queue:
+            queue.remove(future)
+            self.queued -= 1
+            if not queue: del self.waiting[guild_id]
+
+class LLMScheduler:
+    def __init__(self, max_in_flight=16, max_queue=200, max_guild_queue=10, guild_rate=0.5, guild_burst=5, max_wait=20,
+                 background_rate=0.2, background_burst=3):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_guild_queue = max_guild_queue
+        self.max_wait = max_wait
+        # Replies and background work (reflections) have separate buckets and queues, so
+        # reflections never use up a guild's reply budget or count towards its queue cap.
+        # Free slots go to waiting replies first.
+        self.replies = Lane(guild_rate, guild_burst)
+        self.background = Lane(background_rate, background_burst)
+        self.in_flight = 0
+        self.timer = None
+        self.stats = SchedulerStats()
+
+    @property
+    def queued(self):
+        return self.replies.queued
+
+    # Replies pass shed=True: when the queues are full or the wait runs past max_wait
+    # they get Overloaded and answer with a short busy line. Background work passes
+    # shed=False and simply waits its turn in the background lane.
+    @contextlib.asynccontextmanager
+    async def slot(self, guild_id, shed=True):
+        await self.acquire(guild_id, shed)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, guild_id, shed=True):
+        enqueued = time.monotonic()
+        lane = self.replies if shed else self.background
+        bucket = lane.bucket(guild_id)
+        ahead = self.replies.waiting or (not shed and self.background.waiting)
+        if not ahead and self.in_flight < self.max_in_flight and bucket.time_until_token(enqueued) == 0:
+            bucket.take(enqueued)
+            self.in_flight += 1
+            if shed: self.stats.record_wait(0.0)
+            return
+
+        queue = lane.waiting.get(guild_id)
+        if shed and (lane.queued >= self.max_queue or (queue and len(queue) >= self.max_guild_queue)):
+            self.stats.shed += 1
+            raise Overloaded(f"LLM queue full ({lane.queued} waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = lane.waiting[guild_id] = deque()
+        queue.append(future)
+        lane.queued += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(future, self.max_wait if shed else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            lane.forget(guild_id, future)
+            if future.done() and not future.cancelled():
+                # The slot was granted just as we gave up on it; hand it back.
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats.timed_out += 1
+                self.stats.shed += 1
+                raise Overloaded(f"Waited over {self.max_wait}s for an LLM slot")
+            raise
+        if shed: self.stats.record_wait(time.monotonic() - enqueued)
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    # Hands free slots to waiting guilds in round-robin order, replies before background
+    # work, skipping guilds whose bucket is empty. If every waiting guild is out of
+    # tokens, a timer re-runs this when the soonest bucket refills.
+    def _dispatch(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        now = time.monotonic()
+        next_token = None
+        for lane in (self.replies, self.background):
+            while self.in_flight < self.max_in_flight and lane.waiting:
+                progressed = False
+                for guild_id in list(lane.waiting):
+                    bucket = lane.bucket(guild_id)
+                    wait = bucket.time_until_token(now)
+                    if wait > 0:
+                        next_token = wait if next_token is None else min(next_token, wait)
+                        continue
+                    queue = lane.waiting[guild_id]
+                    future = queue.popleft()
+                    lane.queued -= 1
+                    if queue: lane.waiting.move_to_end(guild_id)
+                    else: del lane.waiting[guild_id]
+                    progressed = True
+                    if future.done(): break
+                    bucket.take(now)
+                    self.in_flight += 1
+                    future.set_result(None)
+                    break
+                if not progressed: break
+        waiting = self.replies.waiting or self.background.waiting
+        if waiting and self.in_flight < self.max_in_flight and next_token is not None:
+            self.timer = asyncio.get_running_loop().call_later(next_token, self._dispatch)
+
+    def snapshot(self):
+        return {
+            'in_flight': self.in_flight,
+            'queue_depth': self.replies.queued,
+            'background_queue_depth': self.background.queued,
+            'waiting_guilds': len(self.replies.waiting),
+            'granted': self.stats.granted,
+            'shed': self.stats.shed,
+            'timed_out': self.stats.timed_out,
+            'wait_p50': round(self.stats.wait_percentile(0.5), 3),
+            'wait_p99': round(self.stats.wait_percentile(0.99), 3),
+        }
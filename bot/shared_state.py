@@ -0,0 +1,71 @@
+import asyncio
+import os
+from multiprocessing.managers import BaseManager, DictProxy
+
+# ==================================================================================
+# SHARED STATE
+# When the bot runs as several shard processes, state that spans guilds (right now
+# API key cooldowns, since one key can serve guilds on different shards) has to be
+# seen by every process. Backends share the same small async interface:
+#   LocalStateBackend   - plain dict, for a single process and for testing
+#   ManagerStateBackend - talks to the dict served by cluster.py's state manager
+# Cooldowns are stored as wall-clock timestamps keyed by an opaque name.
+# ==================================================================================
+
+class LocalStateBackend:
+    def __init__(self):
+        self.store = {}
+
+    async def publish_cooldowns(self, cooldowns):
+        for name, until in cooldowns.items():
+            if until > self.store.get(name, 0):
+                self.store[name] = until
+
+    async def fetch_cooldowns(self, now):
+        for name in [name for name, until in self.store.items() if until <= now]:
+            del self.store[name]
+        return dict(self.store)
+
+# cluster.py serves the shared dict through StateManager; workers connect with StateClient.
+class StateManager(BaseManager):
+    pass
+
+class StateClient(BaseManager):
+    pass
+
+StateClient.register('cooldowns', proxytype=DictProxy)
+
+class ManagerStateBackend:
+    def __init__(self, address, authkey):
+        self.manager = StateClient(address=address, authkey=authkey)
+        self.manager.connect()
+        self.cooldowns = self.manager.cooldowns()
+
+    # Manager calls are blocking socket round trips, so they run off the event loop.
+    def _publish(self, cooldowns):
+        for name, until in cooldowns.items():
+            if until > self.cooldowns.get(name, 0):
+                self.cooldowns[name] = until
+
+    def _fetch(self, now):
+        current = self.cooldowns.copy()
+        for name, until in current.items():
+            if until <= now: self.cooldowns.pop(name, None)
+        return {name: until for name, until in current.items() if until > now}
+
+    async def publish_cooldowns(self, cooldowns):
+        await asyncio.to_thread(self._publish, cooldowns)
+
+    async def fetch_cooldowns(self, now):
+        return await asyncio.to_thread(self._fetch, now)
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+# STATE_BACKEND=manager is set by cluster.py for its workers; anything else stays local.
+def make_state_backend():
+    if os.getenv('STATE_BACKEND', 'local') == 'manager':
+        address = parse_address(os.environ['STATE_BACKEND_ADDRESS'])
+        return ManagerStateBackend(address, os.environ['STATE_BACKEND_AUTHKEY'].encode())
+    return LocalStateBackend()
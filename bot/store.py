@@ -0,0 +1,277 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# ==================================================================================
+# EVO DATA LAYER
+# All Firestore access for the bot goes through here. Reads and writes use the
+# AsyncClient so a slow round trip never blocks the event loop; the server config
+# cache keeps using the sync client's snapshot listener, which runs on its own thread.
+# ==================================================================================
+
+# --- Server Config Cache ---
+# Every server_configs document is held in memory and kept current by a Firestore
+# snapshot listener, so on_message never has to hit the network to read settings.
+# Alongside each config we precompile the guild's trigger state (name matcher and
+# designated channel) so irrelevant messages can be dropped without any awaits.
+class GuildTrigger:
+    __slots__ = ('name_pattern', 'channel_id')
+
+    def __init__(self, server_config, default_name):
+        bot_name = server_config.get('custom_bot_name') or default_name
+        self.name_pattern = re.compile(re.escape(bot_name), re.IGNORECASE)
+        designated_channel = server_config.get('designated_channel')
+        self.channel_id = designated_channel if designated_channel and designated_channel != 'all' else None
+
+# In a sharded cluster each process only keeps the guilds on its own shards.
+def shard_for(server_id, shard_count):
+    return (int(server_id) >> 22) % shard_count
+
+class ServerConfigCache:
+    def __init__(self, collection, default_name, shard_count=None, shard_ids=None):
+        self.collection = collection
+        self.default_name = default_name
+        self.shard_count = shard_count
+        self.shard_ids = set(shard_ids) if shard_ids else None
+        self.configs = {}
+        self.triggers = {}
+        self.ready = threading.Event()
+        self.watch = None
+
+    def start(self):
+        self.watch = self.collection.on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        if self.watch:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    def get(self, server_id):
+        return self.configs.get(server_id)
+
+    def owns(self, server_id):
+        if not self.shard_ids: return True
+        return shard_for(server_id, self.shard_count) in self.shard_ids
+
+    # Runs on the listener's background thread. The first call carries every
+    # document as ADDED, later calls only carry what changed on the dashboard.
+    def _on_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            server_id = change.document.id
+            if not self.owns(server_id): continue
+            if change.type.name == 'REMOVED':
+                self.configs.pop(server_id, None)
+                self.triggers.pop(server_id, None)
+            else:
+                server_config = change.document.to_dict()
+                self.triggers[server_id] = GuildTrigger(server_config, self.default_name)
+                self.configs[server_id] = server_config
+        if not self.ready.is_set():
+            print(f"Loaded {len(self.configs)} server configs into cache.")
+            self.ready.set()
+
+# --- Write-Behind Buffer ---
+# User memory writes (history, personal and gossip summaries) are merged per
+# document in memory and flushed every few seconds as Firestore batched writes,
+# so a busy conversation costs one write per interval instead of several per
+# message. Every staged change is appended to a local journal first; on startup
+# the journal is replayed so a crash between flushes does not lose anything.
+FIRESTORE_BATCH_LIMIT = 500
+
+class WriteBehindBuffer:
+    def __init__(self, async_db, journal_path, flush_interval=5.0):
+        self.db = async_db
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.flushing = {}
+        self.task = None
+        self.stopping = None
+        self.flush_lock = asyncio.Lock()
+        self._replay()
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _ref(self, key):
+        server_id, user_id = key
+        return self.db.collection('memories').document(server_id).collection('users').document(user_id)
+
+    def _replay(self):
+        if not os.path.exists(self.journal_path): return
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except ValueError: continue  # a torn final line from a crash mid-write
+                self.pending.setdefault((entry['server_id'], entry['user_id']), {}).update(entry['data'])
+        if self.pending:
+            print(f"Recovered {len(self.pending)} unflushed memory writes from the journal.")
+
+    def _rewrite_journal(self):
+        self.journal.close()
+        with open(self.journal_path, 'w', encoding='utf-8') as f:
+            for (server_id, user_id), data in self.pending.items():
+                f.write(json.dumps({'server_id': server_id, 'user_id': user_id, 'data': data}) + '\n')
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def stage(self, server_id, user_id, data):
+        self.journal.write(json.dumps({'server_id': server_id, 'user_id': user_id, 'data': data}) + '\n')
+        self.journal.flush()
+        self.pending.setdefault((server_id, user_id), {}).update(data)
+
+    # Fields written but not yet committed, so reads see our own writes.
+    def overlay(self, server_id, user_id):
+        key = (server_id, user_id)
+        if key not in self.pending and key not in self.flushing: return None
+        return {**self.flushing.get(key, {}), **self.pending.get(key, {})}
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending: return
+            self.flushing, self.pending = self.pending, {}
+            items = list(self.flushing.items())
+            try:
+                for i in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+                    batch = self.db.batch()
+                    for key, data in items[i:i + FIRESTORE_BATCH_LIMIT]:
+                        batch.set(self._ref(key), data, merge=True)
+                    await batch.commit()
+            except BaseException as e:
+                # Put everything back underneath anything staged since, and retry next interval.
+                # A cancelled commit is restored too; the journal is only rewritten after a confirmed one.
+                for key, data in items:
+                    self.pending[key] = {**data, **self.pending.get(key, {})}
+                if not isinstance(e, Exception): raise
+                print(f"Could not flush {len(items)} memory writes. Will retry. Error: {e}")
+                return
+            finally:
+                self.flushing = {}
+            self._rewrite_journal()
+
+    # Stopped through an event rather than cancel() so a commit in flight always finishes.
+    async def _run(self):
+        while not self.stopping.is_set():
+            try: await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError: pass
+            await self.flush()
+
+    def start(self):
+        if not self.task:
+            self.stopping = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.stopping.set()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+        self.journal.close()
+
+# --- User Memory Cache ---
+# Active conversations re-read the same user documents every few seconds, so the
+# most recently used ones stay in memory. The cache is bounded by entry count and
+# age, and every write goes through it so cached copies never fall behind.
+class UserMemoryCache:
+    def __init__(self, max_entries=5000, ttl=900):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None: return None
+        expires_at, data = entry
+        if time.monotonic() >= expires_at:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        self.entries[key] = (time.monotonic() + self.ttl, data)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # Only documents already cached are patched; anything else is read fresh on next use.
+    def update(self, key, data):
+        entry = self.entries.get(key)
+        if entry is not None: entry[1].update(data)
+
+# --- Async Repository ---
+class EvoStore:
+    def __init__(self, async_db, config_cache, writes, user_cache):
+        self.db = async_db
+        self.configs = config_cache
+        self.writes = writes
+        self.users = user_cache
+        self.loading = {}
+
+    def _server_ref(self, server_id):
+        return self.db.collection('server_configs').document(server_id)
+
+    def _memory_ref(self, server_id, user_id):
+        return self.db.collection('memories').document(server_id).collection('users').document(user_id)
+
+    # Server configs are served from the snapshot cache once it has loaded; before
+    # that (or if the listener never came up) we fall back to a direct async read.
+    async def get_server_config(self, server_id):
+        if self.configs.ready.is_set():
+            return self.configs.get(server_id)
+        doc = await self._server_ref(server_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    # All configs in one go for startup. The snapshot cache already holds them once
+    # its first snapshot has arrived; otherwise they are streamed in a single query.
+    async def load_server_configs(self):
+        if self.configs.ready.is_set():
+            return dict(self.configs.configs)
+        configs = {}
+        async for doc in self.db.collection('server_configs').stream():
+            if self.configs.owns(doc.id): configs[doc.id] = doc.to_dict()
+        return configs
+
+    # Small documents the bot keeps about itself (e.g. the synced command tree hash).
+    async def get_bot_state(self, name):
+        doc = await self.db.collection('bot_state').document(name).get()
+        return doc.to_dict() if doc.exists else {}
+
+    async def set_bot_state(self, name, data):
+        await self.db.collection('bot_state').document(name).set(data, merge=True)
+
+    # Served from the hot cache when possible. On a miss, concurrent readers of the
+    # same document share one Firestore read.
+    async def get_user_memory(self, server_id, user_id):
+        key = (server_id, user_id)
+        cached = self.users.get(key)
+        if cached is not None: return dict(cached)
+        load = self.loading.get(key)
+        if load is None:
+            load = self.loading[key] = asyncio.ensure_future(self._load_user_memory(server_id, user_id))
+            load.add_done_callback(lambda _: self.loading.pop(key, None))
+        return dict(await asyncio.shield(load))
+
+    # Unflushed writes are laid over the stored document. The overlay is taken on
+    # both sides of the read so a flush landing mid-read cannot hide a write.
+    async def _load_user_memory(self, server_id, user_id):
+        unflushed = self.writes.overlay(server_id, user_id)
+        doc = await self._memory_ref(server_id, user_id).get()
+        user_memory = doc.to_dict() if doc.exists else {}
+        for overlay in (unflushed, self.writes.overlay(server_id, user_id)):
+            if overlay: user_memory.update(overlay)
+        self.users.put((server_id, user_id), user_memory)
+        return user_memory
+
+    async def update_user_memory(self, server_id, user_id, data):
+        self.writes.stage(server_id, user_id, data)
+        self.users.update((server_id, user_id), data)
+
+    def start(self):
+        self.writes.start()
+
+    async def close(self):
+        await self.writes.close()
+        self.configs.stop()
@@ -0,0 +1,166 @@
+import asyncio
+import datetime
+from google.cloud.firestore import Increment
+
+# ==================================================================================
+# USAGE LEDGER
+# Counts every successful Gemini call and its tokens per guild per UTC day, for
+# replies and background summaries alike. Counts are added up in memory and
+# flushed every few seconds as Firestore Increments to usage/{guild}/days/{date},
+# so recording a call costs a dict update. A guild's stored totals for the day are
+# read once, on its first message of the day, so quotas survive restarts. In a
+# cluster each guild lives on exactly one process, so the local total is the total.
+#
+# Quotas come from the guild's config (daily_call_quota / daily_token_quota, set
+# by us, not the dashboard) or else the USAGE_DAILY_* defaults. 0 means unlimited.
+# The check runs before a reply starts, so calls already in flight can run a
+# guild slightly past its quota.
+# ==================================================================================
+
+FIRESTORE_BATCH_LIMIT = 500
+
+def today():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+
+class UsageLedger:
+    def __init__(self, async_db, flush_interval=30.0, call_quota=0, token_quota=0):
+        self.db = async_db
+        self.flush_interval = flush_interval
+        self.call_quota = call_quota
+        self.token_quota = token_quota
+        self.totals = {}
+        self.loaded = set()
+        self.pending = {}
+        self.flushed = {}
+        self.loading = {}
+        self.quotas = {}
+        self.notified = set()
+        self.task = None
+        self.stopping = None
+        self.flush_lock = asyncio.Lock()
+
+    def _ref(self, server_id, day):
+        return self.db.collection('usage').document(server_id).collection('days').document(day)
+
+    def quotas_for(self, server_config):
+        return (server_config.get('daily_call_quota') or self.call_quota, server_config.get('daily_token_quota') or self.token_quota)
+
+    # Makes sure today's stored totals for the guild are loaded; concurrent callers share the read.
+    async def load(self, server_id):
+        key = (server_id, today())
+        if key in self.loaded: return
+        load = self.loading.get(key)
+        if load is None:
+            load = self.loading[key] = asyncio.ensure_future(self._load(key))
+            load.add_done_callback(lambda _: self.loading.pop(key, None))
+        await asyncio.shield(load)
+
+    # The read holds the flush lock, so the stored document includes exactly what was
+    # flushed for the key so far. Those counts are already in our local totals (they
+    # were recorded before the first load of the day), so they are taken back out.
+    async def _load(self, key):
+        async with self.flush_lock:
+            flushed = self.flushed.pop(key, {})
+            try:
+                doc = await self._ref(*key).get()
+                stored = doc.to_dict() if doc.exists else {}
+            except Exception as e:
+                print(f"Could not load usage for server {key[0]}. Counting from zero. Error: {e}")
+                stored, flushed = {}, {}
+            counts = self.totals.setdefault(key, {'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0})
+            for field in counts:
+                counts[field] += stored.get(field, 0) - flushed.get(field, 0)
+            self.loaded.add(key)
+        # Drop earlier days' totals once the day has rolled over
+        for old_key in [old_key for old_key in self.totals if old_key[1] != key[1]]:
+            del self.totals[old_key]
+            self.loaded.discard(old_key)
+        for old_key in [old_key for old_key in self.flushed if old_key[1] != key[1]]:
+            del self.flushed[old_key]
+        self.notified = {notified for notified in self.notified if notified[1] == key[1]}
+
+    def record(self, server_id, purpose, response=None):
+        key = (server_id, today())
+        usage = getattr(response, 'usage_metadata', None) if response is not None else None
+        delta = {
+            'calls': 1,
+            'reply_calls' if purpose == 'reply' else 'background_calls': 1,
+            'prompt_tokens': (getattr(usage, 'prompt_token_count', 0) or 0) if usage else 0,
+            'output_tokens': (getattr(usage, 'candidates_token_count', 0) or 0) if usage else 0,
+        }
+        totals = self.totals.setdefault(key, {'calls': 0, 'prompt_tokens': 0, 'output_tokens': 0})
+        pending = self.pending.setdefault(key, {})
+        for field, amount in delta.items():
+            if field in totals: totals[field] += amount
+            pending[field] = pending.get(field, 0) + amount
+
+    # Returns why the guild is over its daily quota, or None.
+    def over_quota(self, server_id, server_config):
+        call_quota, token_quota = self.quotas_for(server_config)
+        self.quotas[server_id] = (call_quota, token_quota)
+        totals = self.totals.get((server_id, today()))
+        if not totals: return None
+        if call_quota and totals['calls'] >= call_quota:
+            return f"{totals['calls']}/{call_quota} calls"
+        if token_quota and totals['prompt_tokens'] + totals['output_tokens'] >= token_quota:
+            return f"{totals['prompt_tokens'] + totals['output_tokens']}/{token_quota} tokens"
+        return None
+
+    # Only the first refused message of the day is answered, the rest are dropped quietly.
+    def notify_once(self, server_id):
+        key = (server_id, today())
+        if key in self.notified: return False
+        self.notified.add(key)
+        return True
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending: return
+            flushing, self.pending = self.pending, {}
+            items = list(flushing.items())
+            for i in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+                batch = self.db.batch()
+                for (server_id, day), counts in items[i:i + FIRESTORE_BATCH_LIMIT]:
+                    data = {field: Increment(amount) for field, amount in counts.items()}
+                    # The quotas in force are stored alongside so the dashboard can show them
+                    call_quota, token_quota = self.quotas.get(server_id, (self.call_quota, self.token_quota))
+                    data.update({'call_quota': call_quota, 'token_quota': token_quota})
+                    batch.set(self._ref(server_id, day), data, merge=True)
+                try:
+                    await batch.commit()
+                except BaseException as e:
+                    # Increments are not idempotent, so only the batches that did not commit go back
+                    self._requeue(items[i:])
+                    if not isinstance(e, Exception): raise
+                    print(f"Could not flush usage for {len(items) - i} servers. Will retry. Error: {e}")
+                    return
+                for key, counts in items[i:i + FIRESTORE_BATCH_LIMIT]:
+                    if key in self.loaded: continue
+                    flushed = self.flushed.setdefault(key, {})
+                    for field, amount in counts.items():
+                        flushed[field] = flushed.get(field, 0) + amount
+
+    def _requeue(self, items):
+        for key, counts in items:
+            pending = self.pending.setdefault(key, {})
+            for field, amount in counts.items():
+                pending[field] = pending.get(field, 0) + amount
+
+    # Stopped through an event rather than cancel() so a commit in flight always finishes.
+    async def _run(self):
+        while not self.stopping.is_set():
+            try: await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError: pass
+            await self.flush()
+
+    def start(self):
+        if not self.task:
+            self.stopping = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.stopping.set()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
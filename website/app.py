@@ -2,13 +2,31 @@ from flask import Flask, jsonify, request, redirect, session
 from flask_cors import CORS
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import firebase_admin
 from firebase_admin import credentials, firestore
 from cryptography.fernet import Fernet
 import traceback
+import hashlib
+import datetime
+import io
+from PIL import Image, ImageOps, UnidentifiedImageError
 from urllib.parse import urlencode
+from discord_cache import DiscordCache
 
 # --- INITIALIZATION ---
+# Under gunicorn's gevent workers (see gunicorn.conf.py) sockets are already patched
+# by the time this module loads; grpc, which the Firestore client uses, has to be
+# told separately or its calls would block the whole worker.
+try:
+    from gevent import monkey
+    if monkey.is_module_patched('socket'):
+        from grpc.experimental import gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+except ImportError:
+    pass
+
 app = Flask(__name__)
 
 # --- CONFIGURATION FROM ENVIRONMENT VARIABLES ---
@@ -47,6 +65,8 @@ app.config.update(
     SESSION_COOKIE_SECURE=True,
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='None',
+    # Request bodies over this are refused while they stream in (avatar uploads are the only large ones)
+    MAX_CONTENT_LENGTH=int(os.getenv('MAX_AVATAR_UPLOAD_MB', 8)) * 1024 * 1024,
 )
 
 # --- DISCORD API DETAILS ---
@@ -54,6 +74,38 @@ API_BASE_URL = 'https://discord.com/api'
 AUTHORIZATION_BASE_URL = 'https://discord.com/api/oauth2/authorize'
 TOKEN_URL = 'https://discord.com/api/oauth2/token'
 
+# --- OUTBOUND HTTP ---
+# Every call to Discord and imgbb shares one pooled session, so connections and
+# TLS sessions are reused instead of set up per request. Timeouts are (connect, read)
+# per upstream; idempotent GETs are retried once or twice on a dropped connection or 5xx.
+DISCORD_TIMEOUT = (3.05, float(os.getenv('DISCORD_TIMEOUT', 10)))
+IMGBB_TIMEOUT = (3.05, float(os.getenv('IMGBB_TIMEOUT', 30)))
+
+http = requests.Session()
+http.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=int(os.getenv('HTTP_POOL_SIZE', 50)),
+    max_retries=Retry(total=2, read=0, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET']), raise_on_status=False)
+))
+
+# Read-only Discord lookups go through a per-process cache (see discord_cache.py).
+# TTLs are (fresh, extra seconds served stale while refreshing).
+discord_cache = DiscordCache(http, DISCORD_TIMEOUT)
+BOT_INFO_TTL = (3600, 86400)
+USER_GUILDS_TTL = (60, 600)
+CHANNELS_TTL = (30, 300)
+
+# Guild lists are cached per user token without keeping the token itself as a key
+def token_cache_key(token):
+    return hashlib.sha256(token['access_token'].encode()).hexdigest()[:32]
+
+# A 429 from the cache (or straight from Discord) is passed on with its retry_after.
+# The dashboard waits that long and retries (fetchWithRetry in index.html) instead of
+# showing an empty list, and keeps Save disabled until the channel list has loaded.
+def rate_limited(data):
+    retry_after = (data or {}).get('retry_after', 1)
+    return jsonify({"error": "Discord is rate limiting this request. Please try again shortly.", "retry_after": retry_after}), 429
+
 # --- HELPER FUNCTIONS ---
 def encrypt_key(key):
     if not key: return ""
@@ -66,8 +118,69 @@ def decrypt_key(encrypted_key):
     except Exception:
         return ""
 
+# Guilds the user administers, keyed by id, in Discord's order.
+def get_admin_guilds(user_guilds):
+    return {g['id']: g for g in user_guilds if (int(g['permissions']) & 0x8) == 0x8}
+
+def guild_summary(guild):
+    icon_hash = guild.get('icon')
+    icon_url = f"https://cdn.discordapp.com/icons/{guild['id']}/{icon_hash}.png" if icon_hash else f"https://placehold.co/64x64/7f9cf5/ffffff?text={guild.get('name', '?')[0]}"
+    return {"id": guild['id'], "name": guild.get('name'), "icon": icon_url}
+
+# Only the user's own guilds are looked up, in chunked batch gets with an empty field
+# mask, so the cost follows how many servers they admin rather than total installs.
+SERVER_LOOKUP_CHUNK = 100
+
+def get_configured_server_ids(server_ids):
+    refs = [db.collection('server_configs').document(server_id) for server_id in server_ids]
+    configured_ids = set()
+    for i in range(0, len(refs), SERVER_LOOKUP_CHUNK):
+        for doc in db.get_all(refs[i:i + SERVER_LOOKUP_CHUNK], field_paths=[]):
+            if doc.exists: configured_ids.add(doc.id)
+    return configured_ids
+
+# --- AVATAR UPLOADS ---
+# Webhook avatars are shown at 128px at most, so uploads are shrunk to AVATAR_SIZE and
+# re-encoded before they go to imgbb; Discord then fetches a few KB per message instead
+# of the original file. Uploads are keyed by the hash of their bytes in avatar_uploads,
+# so re-uploading an image we already have skips the processing and the imgbb call.
+AVATAR_SIZE = 256
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
+def hash_upload(stream, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def prepare_avatar(stream):
+    image = Image.open(stream)
+    # JPEGs can be decoded straight at a fraction of their size, which is most of the cost
+    image.draft('RGB', (AVATAR_SIZE * 2, AVATAR_SIZE * 2))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P') and (image.mode != 'P' or 'transparency' in image.info):
+        image.convert('RGBA').save(output, 'PNG', optimize=True)
+        filename, mimetype = 'avatar.png', 'image/png'
+    else:
+        image.convert('RGB').save(output, 'JPEG', quality=88, optimize=True)
+        filename, mimetype = 'avatar.jpg', 'image/jpeg'
+    output.seek(0)
+    return filename, output, mimetype
+
 # --- API ROUTES ---
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"That file is too large. The limit is {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB."}), 413
+
+@app.errorhandler(requests.RequestException)
+def upstream_error(e):
+    print(f"Upstream request failed: {e}")
+    return jsonify({"error": "Discord did not respond in time. Please try again."}), 502
+
 @app.route('/')
 def home():
     return jsonify({"status": "online", "message": "Evo Backend is running successfully!"})
@@ -77,18 +190,16 @@ def get_bot_info():
     if not BOT_TOKEN: return jsonify({"error": "Bot token not configured"}), 500
     headers = {"Authorization": f"Bot {BOT_TOKEN}"}
     
-    app_response = requests.get(f"{API_BASE_URL}/oauth2/applications/@me", headers=headers)
-    if app_response.status_code == 200:
-        app_info = app_response.json()
+    app_status, app_info = discord_cache.get(('application',), f"{API_BASE_URL}/oauth2/applications/@me", headers, *BOT_INFO_TTL)
+    if app_status == 200:
         icon_hash = app_info.get('icon')
         app_id = app_info.get('id')
         if icon_hash:
             avatar_url = f"https://cdn.discordapp.com/app-icons/{app_id}/{icon_hash}.png?size=64"
             return jsonify({"avatar": avatar_url})
 
-    user_response = requests.get(f"{API_BASE_URL}/users/@me", headers=headers)
-    if user_response.status_code == 200:
-        bot_user = user_response.json()
+    user_status, bot_user = discord_cache.get(('bot_user',), f"{API_BASE_URL}/users/@me", headers, *BOT_INFO_TTL)
+    if user_status == 200:
         avatar_hash = bot_user.get('avatar')
         bot_id = bot_user.get('id')
         if avatar_hash:
@@ -111,15 +222,25 @@ def upload_avatar(server_id):
     payload = {"key": IMGBB_API_KEY}
     
     try:
-        response = requests.post(imgbb_api_url, params=payload, files={"image": file})
-        response.raise_for_status()
-        imgbb_data = response.json()
-        if imgbb_data.get('success'):
-            avatar_url = imgbb_data['data']['url']
-            db.collection('server_configs').document(server_id).update({"custom_avatar_url": avatar_url})
-            return jsonify({"success": True, "avatar_url": avatar_url})
+        upload_hash = hash_upload(file.stream)
+        upload_ref = db.collection('avatar_uploads').document(upload_hash)
+        known_upload = upload_ref.get()
+        if known_upload.exists:
+            avatar_url = known_upload.to_dict()['url']
         else:
-            return jsonify({"error": imgbb_data.get('error', {}).get('message', 'imgbb API returned an error')}), 500
+            try:
+                image = prepare_avatar(file.stream)
+            except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+                return jsonify({"error": "That file is not an image we can use."}), 400
+            response = http.post(imgbb_api_url, params=payload, files={"image": image}, timeout=IMGBB_TIMEOUT)
+            response.raise_for_status()
+            imgbb_data = response.json()
+            if not imgbb_data.get('success'):
+                return jsonify({"error": imgbb_data.get('error', {}).get('message', 'imgbb API returned an error')}), 500
+            avatar_url = imgbb_data['data']['url']
+            upload_ref.set({"url": avatar_url, "uploaded_at": firestore.SERVER_TIMESTAMP})
+        db.collection('server_configs').document(server_id).update({"custom_avatar_url": avatar_url})
+        return jsonify({"success": True, "avatar_url": avatar_url})
     except Exception as e:
         return jsonify({"error": f"Failed to upload image: {e}"}), 500
 
@@ -158,14 +279,14 @@ def callback():
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
         }
         
-        token_response = requests.post(TOKEN_URL, data=data, headers=headers)
+        token_response = http.post(TOKEN_URL, data=data, headers=headers, timeout=DISCORD_TIMEOUT)
         token_response.raise_for_status()
         token_data = token_response.json()
 
         session['discord_token'] = token_data
 
         user_headers = { 'Authorization': f"Bearer {token_data['access_token']}" }
-        user_info_response = requests.get(f"{API_BASE_URL}/users/@me", headers=user_headers)
+        user_info_response = http.get(f"{API_BASE_URL}/users/@me", headers=user_headers, timeout=DISCORD_TIMEOUT)
         user_info_response.raise_for_status()
         user_info = user_info_response.json()
         session['user'] = user_info
@@ -196,20 +317,13 @@ def get_user_servers():
     
     token = session.get('discord_token')
     headers = { 'Authorization': f"Bearer {token['access_token']}" }
-    response = requests.get(f"{API_BASE_URL}/users/@me/guilds", headers=headers)
-    user_guilds = response.json() if response.status_code == 200 else []
+    status, user_guilds = discord_cache.get(('user_guilds', token_cache_key(token)), f"{API_BASE_URL}/users/@me/guilds", headers, *USER_GUILDS_TTL)
+    if status == 429: return rate_limited(user_guilds)
+    if status != 200: user_guilds = []
     
-    admin_guild_ids = {g['id'] for g in user_guilds if (int(g['permissions']) & 0x8) == 0x8}
-
-    configs_ref = db.collection('server_configs').stream()
-    user_admin_configs = []
-    for config in configs_ref:
-        if config.id in admin_guild_ids:
-            matching_guild = next((g for g in user_guilds if g['id'] == config.id), None)
-            if matching_guild:
-                icon_hash = matching_guild.get('icon')
-                icon_url = f"https://cdn.discordapp.com/icons/{config.id}/{icon_hash}.png" if icon_hash else f"https://placehold.co/64x64/7f9cf5/ffffff?text={matching_guild.get('name', '?')[0]}"
-                user_admin_configs.append({"id": config.id, "name": matching_guild.get('name'), "icon": icon_url})
+    admin_guilds = get_admin_guilds(user_guilds)
+    configured_ids = get_configured_server_ids(admin_guilds)
+    user_admin_configs = [guild_summary(guild) for guild_id, guild in admin_guilds.items() if guild_id in configured_ids]
     return jsonify(user_admin_configs)
 
 @app.route('/api/available-servers', methods=['GET'])
@@ -219,19 +333,13 @@ def get_available_servers():
     
     token = session.get('discord_token')
     headers = { 'Authorization': f"Bearer {token['access_token']}" }
-    response = requests.get(f"{API_BASE_URL}/users/@me/guilds", headers=headers)
-    user_guilds = response.json() if response.status_code == 200 else []
-    
-    configs_ref = db.collection('server_configs').stream()
-    configured_guild_ids = {config.id for config in configs_ref}
+    status, user_guilds = discord_cache.get(('user_guilds', token_cache_key(token)), f"{API_BASE_URL}/users/@me/guilds", headers, *USER_GUILDS_TTL)
+    if status == 429: return rate_limited(user_guilds)
+    if status != 200: user_guilds = []
     
-    available_guilds = []
-    for guild in user_guilds:
-        if (int(guild['permissions']) & 0x8) == 0x8 and guild['id'] not in configured_guild_ids:
-            icon_hash = guild.get('icon')
-            icon_url = f"https://cdn.discordapp.com/icons/{guild['id']}/{icon_hash}.png" if icon_hash else f"https://placehold.co/64x64/7f9cf5/ffffff?text={guild.get('name', '?')[0]}"
-            available_guilds.append({"id": guild['id'], "name": guild['name'], "icon": icon_url})
-            
+    admin_guilds = get_admin_guilds(user_guilds)
+    configured_ids = get_configured_server_ids(admin_guilds)
+    available_guilds = [guild_summary(guild) for guild_id, guild in admin_guilds.items() if guild_id not in configured_ids]
     return jsonify(available_guilds)
 
 @app.route('/api/remove-server/<server_id>', methods=['DELETE'])
@@ -250,14 +358,15 @@ def get_server_channels(server_id):
     if not BOT_TOKEN: return jsonify({"error": "Bot token not configured"}), 500
 
     headers = {"Authorization": f"Bot {BOT_TOKEN}"}
-    response = requests.get(f"{API_BASE_URL}/guilds/{server_id}/channels", headers=headers)
+    status, all_channels = discord_cache.get(('channels', server_id), f"{API_BASE_URL}/guilds/{server_id}/channels", headers, *CHANNELS_TTL)
     
-    if response.status_code == 200:
-        all_channels = response.json()
+    if status == 200:
         text_channels = [{"id": ch["id"], "name": ch["name"]} for ch in all_channels if ch["type"] == 0]
         return jsonify(text_channels)
+    elif status == 429:
+        return rate_limited(all_channels)
     else:
-        return jsonify({"error": "Failed to fetch channels. Is the bot on this server?"}), response.status_code
+        return jsonify({"error": "Failed to fetch channels. Is the bot on this server?"}), status
 
 @app.route('/api/server-settings/<server_id>', methods=['GET'])
 def get_server_settings(server_id):
@@ -275,6 +384,10 @@ def get_server_settings(server_id):
         data["backup_api_key_last4"] = backup_key[-4:] if backup_key else ""
         if "encrypted_api_key" in data: del data["encrypted_api_key"]
         if "encrypted_backup_api_key" in data: del data["encrypted_backup_api_key"]
+        # Today's Gemini usage as counted by the bot (UTC day), with the quotas it enforces
+        today = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+        usage_doc = db.collection('usage').document(server_id).collection('days').document(today).get()
+        data["usage_today"] = usage_doc.to_dict() if usage_doc.exists else {}
         return jsonify(data)
     else:
         return jsonify({"error": "No settings found for this server."}), 404
@@ -291,7 +404,9 @@ def save_server_settings(server_id):
         "ai_model": settings.get('ai_model'),
         "designated_channel": settings.get('designated_channel'),
         'custom_bot_name': settings.get('custom_name'),
-        'custom_personality': settings.get('custom_personality')
+        'custom_personality': settings.get('custom_personality'),
+        'streaming_replies': bool(settings.get('streaming_replies')),
+        'response_cache': bool(settings.get('response_cache'))
     }
 
     if settings.get('api_key'):
@@ -303,6 +418,7 @@ def save_server_settings(server_id):
     
     return jsonify({"status": "success", "message": f"Settings for server {server_id} saved."})
 
+# Local development only; production runs `gunicorn app:app` with gunicorn.conf.py
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
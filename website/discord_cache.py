@@ -0,0 +1,115 @@
+import time
+import threading
+import requests
+from collections import OrderedDict
+
+# --- Discord Response Cache ---
+# Dashboard pages re-request the same guild lists, channel lists and bot info over
+# and over, and Discord's per-route rate limits are small. Successful GETs are kept
+# per key (user token hash, guild id, ...) for a fresh TTL, then served stale for a
+# while longer while a single background request refreshes them. Concurrent misses
+# for the same key share one request, and when Discord says a route is exhausted
+# (X-RateLimit-Remaining: 0 or a 429) the key is not requested again until the
+# reset, serving the stale copy if there is one.
+#
+# Under gunicorn's gevent workers the threading primitives here are patched into
+# greenlet ones, so a background refresh is a greenlet, not an OS thread.
+
+class CacheEntry:
+    __slots__ = ('data', 'fresh_until', 'stale_until')
+
+    def __init__(self, data, ttl, stale_ttl):
+        now = time.monotonic()
+        self.data = data
+        self.fresh_until = now + ttl
+        self.stale_until = now + ttl + stale_ttl
+
+class PendingFetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class DiscordCache:
+    def __init__(self, session, timeout, max_entries=5000):
+        self.session = session
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.blocked_until = {}
+        self.lock = threading.Lock()
+
+    # Returns (status_code, json_body) like the bare request would have.
+    def get(self, key, url, headers, ttl, stale_ttl):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if now < entry.fresh_until: return 200, entry.data
+            blocked_until = self.blocked_until.get(key, 0)
+            if blocked_until <= now: self.blocked_until.pop(key, None)
+            rate_limited = blocked_until > now
+
+            if entry is not None and (now < entry.stale_until or rate_limited):
+                if not rate_limited and key not in self.pending:
+                    self.pending[key] = PendingFetch()
+                    threading.Thread(target=self._refresh, args=(key, url, headers, ttl, stale_ttl), daemon=True).start()
+                return 200, entry.data
+            if rate_limited:
+                return 429, {"error": "Discord is rate limiting this request. Please try again shortly.", "retry_after": round(blocked_until - now, 1)}
+
+            fetch = self.pending.get(key)
+            leader = fetch is None
+            if leader: fetch = self.pending[key] = PendingFetch()
+
+        if leader: return self._fetch(key, url, headers, ttl, stale_ttl)
+        fetch.done.wait(self.timeout[1] if isinstance(self.timeout, tuple) else self.timeout)
+        if fetch.error: raise fetch.error
+        if fetch.result is None: raise requests.Timeout(f"Timed out waiting for a shared request to {url}")
+        return fetch.result
+
+    def _fetch(self, key, url, headers, ttl, stale_ttl):
+        fetch = self.pending[key]
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            fetch.result = self._store(key, response, ttl, stale_ttl)
+            return fetch.result
+        except requests.RequestException as e:
+            fetch.error = e
+            raise
+        finally:
+            with self.lock: self.pending.pop(key, None)
+            fetch.done.set()
+
+    def _refresh(self, key, url, headers, ttl, stale_ttl):
+        try: self._fetch(key, url, headers, ttl, stale_ttl)
+        except requests.RequestException as e: print(f"Background refresh of {url} failed. Serving the cached copy. Error: {e}")
+
+    def _store(self, key, response, ttl, stale_ttl):
+        try: data = response.json()
+        except ValueError: data = None
+        self._note_rate_limit(key, response, data)
+        with self.lock:
+            if response.status_code == 200:
+                self.entries[key] = CacheEntry(data, ttl, stale_ttl)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                return 200, data
+            # A failed refresh keeps serving whatever copy we still have
+            entry = self.entries.get(key)
+            if entry is not None and (response.status_code == 429 or response.status_code >= 500):
+                return 200, entry.data
+        return response.status_code, data
+
+    def _note_rate_limit(self, key, response, data):
+        reset_after = None
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After') or (data or {}).get('retry_after')
+            reset_after = float(retry_after or 1)
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            reset_after = float(response.headers.get('X-RateLimit-Reset-After') or 1)
+        if reset_after:
+            with self.lock: self.blocked_until[key] = time.monotonic() + reset_after
@@ -0,0 +1,14 @@
+import os
+import multiprocessing
+
+# --- Production Server ---
+# gunicorn picks this file up automatically (`gunicorn app:app`). gevent workers
+# let each process hold many dashboard requests at once, so a slow call to
+# Discord or imgbb only parks that request instead of tying up the worker.
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 500))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+keepalive = 5
+accesslog = '-'